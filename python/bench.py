@@ -0,0 +1,473 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+
+"""
+Micro-benchmarks for t.py.
+
+    python bench.py tokenize|clean|train|geo|live|score [--repeat N] [--rate N] [--sample 20120101.txt] [--sizes N ...]
+                    [--tweets N] [--train_tweets N] [--rare_alpha A]
+    python bench.py suite [--sizes N ...] [--out bench.json] [--compare old.json]
+
+tokenize -- tokens/sec of the old findall() + replace_special() path
+            against the single-pass tagged_word_re path, on the bundled
+            tweet sample. Both paths must produce the same tokens.
+clean    -- lines/sec of one re.sub() per rule against the combined
+            Clean_Rules pattern, for 20, 200 and 2000 boilerplate rules.
+train    -- NGram_Helpers training time at 10k, 100k and 1M synthetic
+            samples (--sizes to change), single pass against three
+            loop() passes; the per-sample time should stay flat.
+geo      -- locations/sec of the old split(', ') + list scan against
+            Geo_Index.match_many(), with and without the bbox test.
+live     -- replays synthetic tweets through Live_Pipeline at --rate
+            payloads/sec (0 for as fast as possible) and reports the
+            sustained rate, drops and end-to-end latency percentiles.
+score    -- tweets/sec of the old per-tweet pr_gram() scoring against
+            NGram_Scorer batches, on a model trained from --train_tweets
+            synthetic tweets; --tweets are scored, and must agree to 1e-9.
+            The pre-tokenized row times the scoring step alone; end to
+            end, tokenizing bounds the gain.
+suite    -- every case in SUITE at each of --sizes (default 1k, 10k,
+            100k), each in a fresh interpreter so its peak RSS is its
+            own. Corpora are seeded, so runs are comparable; results go
+            to --out as JSON, and --compare prints the throughput ratio
+            to an earlier results file.
+"""
+
+import argparse
+import codecs
+import collections
+import json
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import t
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '20120101.txt')
+
+def read_sample(file_name=SAMPLE):
+    with codecs.open(file_name, encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+def timed(fn, lines, repeat):
+    tokens = 0
+    start = time.time()
+    for i in range(repeat):
+        for line in lines:
+            tokens += len(fn(line))
+    return tokens, time.time() - start
+
+def bench_tokenize(lines, repeat):
+    tok = t.Tokenizer(preserve_case=False)
+    html2unicode = tok._Tokenizer__html2unicode
+
+    def legacy(s):
+        words = t.word_re.findall(html2unicode(unicode(s)))
+        words = map(tok.replace_special, words)
+        return [w for w in words if w not in t.Stop_List]
+
+    def single_pass(s):
+        return [w for w, kind in tok.tokenize_tagged(s)]
+
+    for line in lines:
+        assert legacy(line) == single_pass(line), line
+    results = {}
+    for name, fn in (('findall+replace_special', legacy), ('tagged_word_re', single_pass)):
+        tokens, elapsed = timed(fn, lines, repeat)
+        results[name] = tokens / elapsed
+        print "%-24s %8d tokens %7.3fs %10.0f tokens/sec" % (name, tokens, elapsed, tokens / elapsed)
+    print "speedup: %.2fx" % (results['tagged_word_re'] / results['findall+replace_special'])
+    return results
+
+def synthetic_rules(count, seed=0):
+    rng = random.Random(seed)
+    words = [w for w in re.findall(r"[a-z]+", open(SAMPLE).read().lower()) if len(w) > 2]
+    rules = set()
+    while len(rules) < count:
+        rules.add(" ".join(rng.choice(words) for i in range(rng.randint(3, 8))).title())
+    return sorted(rules)
+
+def synthetic_posts(rules, count=2000, seed=0):
+    rng = random.Random(seed)
+    lines = read_sample()
+    posts = []
+    for i in range(count):
+        post = rng.choice(lines).encode('utf-8')
+        if rng.random() < 0.2:
+            post += " " + rng.choice(rules)
+        posts.append(post)
+    return posts
+
+def bench_clean(rule_counts, repeat):
+    results = {}
+    for count in rule_counts:
+        rules = synthetic_rules(count)
+        posts = synthetic_posts(rules)
+        sequential = [re.compile(re.escape(rule)) for rule in rules]
+        combined = t.Clean_Rules([(rule, "", False) for rule in rules])
+
+        def one_sub_per_rule(s):
+            for rule_re in sequential:
+                s = rule_re.sub("", s)
+            return s
+
+        for post in posts:
+            assert one_sub_per_rule(post) == combined.sub(post), post
+        for name, fn in (('re.sub per rule', one_sub_per_rule), ('Clean_Rules', combined.sub)):
+            start = time.time()
+            for i in range(repeat):
+                for post in posts:
+                    fn(post)
+            elapsed = time.time() - start
+            results[(count, name)] = len(posts) * repeat / elapsed
+            print "%5d rules  %-16s %10.0f lines/sec" % (count, name, results[(count, name)])
+    return results
+
+def synthetic_tweets(count, seed=0, rare_alpha=0.5):
+    """
+    Tweets made of words from the bundled sample plus a long tail of rare
+    made-up words, so the vocabulary keeps growing with the corpus. The
+    rare words' ids are Pareto distributed with shape rare_alpha; the
+    lower it is, the longer the tail. train used 1.2 when it was added,
+    everything from score on 0.5.
+    """
+    rng = random.Random(seed)
+    words = re.findall(r"\S+", open(SAMPLE).read())
+    tweets = []
+    for i in range(count):
+        tweet = [rng.choice(words) if rng.random() < 0.8 else "w%d" % int(rng.paretovariate(rare_alpha))
+                 for j in range(rng.randint(4, 20))]
+        tweets.append(" ".join(tweet))
+    return tweets
+
+def bench_train(sizes, legacy_limit=100000, rare_alpha=1.2):
+    t.tok = t.Tokenizer(preserve_case=False)
+    results = {}
+    for size in sizes:
+        samples = synthetic_tweets(size, rare_alpha=rare_alpha)
+        start = time.time()
+        n = t.NGram_Helpers(samples)
+        elapsed = time.time() - start
+        results[(size, 'count_samples')] = elapsed
+        print "%8d samples  %-14s %7.2fs %8.1f us/sample  %d trigrams" % (size, 'count_samples', elapsed, elapsed / size * 1e6, len(n.trigrams))
+        if size <= legacy_limit:
+            start = time.time()
+            for num in (1, 2, 3):
+                n.loop(samples, num, 1)
+            elapsed = time.time() - start
+            results[(size, 'loop x3')] = elapsed
+            print "%8d samples  %-14s %7.2fs %8.1f us/sample" % (size, 'loop x3', elapsed, elapsed / size * 1e6)
+    return results
+
+def legacy_tweet_pr(models, tweet, weights):
+    """
+    The --test loop as it was: string n-gram keys, JSON dicts and a
+    sum over the unigram counts for every tweet.
+    """
+    n = t.NGram_Helpers
+    three_gram, two_gram, one_gram = models
+    l1, l2, l3, l4 = weights
+    ngram_base = n.build_tweet(tweet, 3, 1)
+    tri_gram = n.build_ngrams(ngram_base, 3)
+    duo_gram = n.build_ngrams(ngram_base, 2)
+    uno_gram = n.build_ngrams(ngram_base, 1)
+    length = sum(one_gram.values())
+    count_3_list = n.pr_gram(three_gram, tri_gram)
+    count_2_list = n.pr_gram(two_gram, duo_gram[:len(tri_gram)])
+    count_1_list = n.pr_gram(one_gram, uno_gram[:len(tri_gram)])
+    st_pr = n.start_probability(count_3_list[0], count_2_list[0], l1, l4, length)
+    pr = n.probability(count_3_list[1], count_2_list[1], count_1_list[1], l1, l2, l3, l4, length)
+    if st_pr != 0.0 and pr != 0.0:
+        pr = st_pr * pr
+    return pr
+
+def bench_score(train_size=100000, test_size=5000, weights=(0.85, 0.1, 0.04, 0.01), rare_alpha=0.5):
+    t.tok = t.Tokenizer(preserve_case=False)
+    n = t.NGram_Helpers(synthetic_tweets(train_size, rare_alpha=rare_alpha))
+    models = (n.trigrams.to_dict(), n.bigrams.to_dict(), n.unigrams.to_dict())
+    tweets = synthetic_tweets(test_size, seed=1, rare_alpha=rare_alpha)
+    results = {}
+    start = time.time()
+    legacy = [legacy_tweet_pr(models, tweet, weights) for tweet in tweets]
+    results['pr_gram'] = test_size / (time.time() - start)
+    scorer = t.NGram_Scorer(n.trigrams, n.bigrams, n.unigrams, weights)
+    start = time.time()
+    scores = scorer.scores(tweets)
+    results['NGram_Scorer'] = test_size / (time.time() - start)
+    token_lists = list(t.tok.tokenize_many(tweets))
+    start = time.time()
+    scorer.log_scores_from_counts(scorer.count_vectors(token_lists))
+    results['NGram_Scorer (pre-tokenized)'] = test_size / (time.time() - start)
+    for a, b in zip(legacy, scores):
+        assert abs(a - b) <= 1e-9 * abs(a), (a, b)
+    print "%d training tweets, %d scored, largest relative difference from pr_gram %.2g" % (
+        train_size, test_size, max(abs(a - b) / abs(a) if a else abs(b) for a, b in zip(legacy, scores)))
+    for name in ('pr_gram', 'NGram_Scorer', 'NGram_Scorer (pre-tokenized)'):
+        print "%-30s %10.0f tweets/sec %6.1fx" % (name, results[name], results[name] / results['pr_gram'])
+    return results
+
+def synthetic_locations(count, seed=0):
+    rng = random.Random(seed)
+    places = t.Geo + ['Paris, France', 'London', 'Tokyo', 'somewhere over the rainbow', 'Brasil', '']
+    locations = []
+    for i in range(count):
+        kind = rng.random()
+        if kind < 0.4:
+            location = "%s, %s" % (rng.choice(['Springfield', 'Austin', 'Home']), rng.choice(places))
+        elif kind < 0.6:
+            location = "living in %s" % rng.choice(places).lower()
+        elif kind < 0.7:
+            location = "iPhone: %.5f,%.5f" % (rng.uniform(-60, 70), rng.uniform(-170, 170))
+        else:
+            location = rng.choice(places)
+        locations.append(location)
+    return locations
+
+def bench_geo(count=200000):
+    locations = synthetic_locations(count)
+
+    def legacy(location):
+        for g in location.split(', '):
+            if g in t.Geo:
+                return True
+        return False
+
+    results = {}
+    start = time.time()
+    kept = sum(legacy(location) for location in locations)
+    results['list scan'] = (count / (time.time() - start), kept)
+    for name, index in (('Geo_Index', t.Geo_Index()), ('Geo_Index + bbox', t.Geo_Index(bbox=t.Geo_Index.US_BBOX))):
+        start = time.time()
+        kept = sum(index.match_many(locations))
+        results[name] = (count / (time.time() - start), kept)
+    for name in ('list scan', 'Geo_Index', 'Geo_Index + bbox'):
+        rate, kept = results[name]
+        print "%-18s %10.0f locations/sec %10.1fM/min  %6d kept" % (name, rate, rate * 60 / 1e6, kept)
+    return results
+
+class Null_Sink:
+    def write(self, results):
+        pass
+
+    def close(self):
+        pass
+
+def bench_live(rate=0, count=50000, train_size=100000, workers=2, queue_size=10000):
+    t.tok = t.Tokenizer(preserve_case=False, cache_size=10000)
+    n = t.NGram_Helpers(synthetic_tweets(train_size))
+    t.File_Utils.scorer = t.NGram_Scorer(n.trigrams, n.bigrams, n.unigrams)
+    replay_file = os.path.join(tempfile.mkdtemp(), 'replay.jsonl')
+    with open(replay_file, 'w') as f:
+        for i, tweet in enumerate(synthetic_tweets(count, seed=1)):
+            f.write(t.Replay_Tweet.tweet_json(i, tweet.decode('utf-8', 'replace')) + '\n')
+    pipeline = t.Live_Pipeline(Null_Sink(), workers=workers, queue_size=queue_size).start()
+    replay = t.Replay_Tweet(replay_file, rate)
+    start = time.time()
+    replay.tokenize_live_tweet(t.Live_Client(pipeline))
+    pipeline.stop()
+    elapsed = time.time() - start
+    shutil.rmtree(os.path.dirname(replay_file))
+    snap = pipeline.metrics.snapshot()
+    total = snap['total_ms']
+    print "offered %.0f/sec  sent %d in %.2fs  scored %d  dropped %d" % (
+        replay.sent / replay.elapsed, replay.sent, replay.elapsed, snap.get('scored', 0), snap.get('dropped', 0))
+    print "sustained %.0f tweets/sec  end-to-end p50 %.1f p95 %.1f p99 %.1f ms" % (
+        snap.get('scored', 0) / elapsed, total['p50'], total['p95'], total['p99'])
+    return snap
+
+def synthetic_forum(count, seed=0):
+    """
+    Forum lines: synthetic tweets, with the literal boilerplate of
+    clean_rules.txt appended to some and about a tenth repeated.
+    """
+    rng = random.Random(seed)
+    rules = sorted(t.Clean_Rules.read(os.path.join(t.script_dir, 'clean_rules.txt')).literals)
+    lines = []
+    for post in synthetic_tweets(count, seed):
+        if lines and rng.random() < 0.1:
+            lines.append(rng.choice(lines))
+            continue
+        if rng.random() < 0.3:
+            post += " " + rng.choice(rules)
+        lines.append(post + "\n")
+    return lines
+
+def synthetic_tsv(count, seed=0):
+    rng = random.Random(seed)
+    locations = synthetic_locations(count, seed)
+    return ["\t".join([str(i), "user%d" % rng.randint(0, 1000), "Sun Jan 01 00:00:00 +0000 2012",
+                       locations[i], tweet.replace("\t", " ")]) + "\n"
+            for i, tweet in enumerate(synthetic_tweets(count, seed))]
+
+def case_model(size=10000):
+    n = t.NGram_Helpers(synthetic_tweets(size, seed=7))
+    t.File_Utils.scorer = t.NGram_Scorer(n.trigrams, n.bigrams, n.unigrams)
+
+def case_tokenize(size):
+    tweets = synthetic_tweets(size)
+    start = time.time()
+    tokens = sum(len(t.tok.tokenize(tweet)) for tweet in tweets)
+    return time.time() - start, size, {'tokens': tokens}
+
+def case_train(size):
+    tweets = synthetic_tweets(size)
+    start = time.time()
+    n = t.NGram_Helpers(tweets)
+    return time.time() - start, size, {'trigrams': len(n.trigrams)}
+
+def case_score(size):
+    case_model()
+    tweets = synthetic_tweets(size, seed=1)
+    start = time.time()
+    for i in range(0, size, 10000):
+        t.File_Utils.tweet_pr_batch(tweets[i:i + 10000])
+    return time.time() - start, size, {}
+
+def case_tweet_pr(size):
+    case_model()
+    tweets = [tweet.decode('utf-8', 'replace') for tweet in synthetic_tweets(size, seed=1)]
+    start = time.time()
+    for tweet in tweets:
+        t.File_Utils.tweet_pr(tweet)
+    return time.time() - start, size, {}
+
+def case_clean_posts(size):
+    fi = t.File_Utils()
+    fi.read_clean_rules()
+    lines = synthetic_forum(size)
+    start = time.time()
+    for line in lines:
+        fi.clean_posts(line)
+    return time.time() - start, size, {}
+
+def case_gather(size, files=10):
+    fi = t.File_Utils()
+    fi.read_clean_rules()
+    t.File_Utils.dup_filter = t.Dup_Filter()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        lines = synthetic_forum(size)
+        for i in range(files):
+            with open(os.path.join(tmp_dir, "forum%d" % i), 'w') as f:
+                f.writelines(lines[i::files])
+        start = time.time()
+        fi.gather(fi.crawl_directory(tmp_dir), tmp_dir)
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(tmp_dir)
+    return elapsed, size, {'duplicates': t.File_Utils.dup_filter.duplicates}
+
+def case_parse_tsv(size, files=4):
+    case_model()
+    fi = t.File_Utils()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        rows = synthetic_tsv(size)
+        for i in range(files):
+            with open(os.path.join(tmp_dir, "tweets%d.tsv" % i), 'w') as f:
+                f.writelines(rows[i::files])
+        out_dir = os.path.join(tmp_dir, 'out')
+        os.mkdir(out_dir)
+        start = time.time()
+        counts = fi.parse_tsv_tweets(fi.crawl_directory(tmp_dir), tmp_dir, out_dir)
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(tmp_dir)
+    return elapsed, size, {'kept': sum(written for name, read, written in counts)}
+
+# name: (function, unit of the size)
+SUITE = collections.OrderedDict([
+    ('tokenize', (case_tokenize, 'tweets')),
+    ('train', (case_train, 'tweets')),
+    ('score', (case_score, 'tweets')),
+    ('tweet_pr', (case_tweet_pr, 'tweets')),
+    ('clean_posts', (case_clean_posts, 'lines')),
+    ('gather', (case_gather, 'lines')),
+    ('parse_tsv', (case_parse_tsv, 'rows')),
+])
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_case(name, size):
+    """
+    Runs one SUITE case in this process and prints its result as JSON.
+    """
+    random.seed(0)
+    np.random.seed(0)
+    t.tok = t.Tokenizer(preserve_case=False)
+    base_rss = peak_rss_mb()
+    fn, unit = SUITE[name]
+    elapsed, items, extra = fn(size)
+    result = {'bench': name, 'size': size, 'unit': unit, 'seconds': elapsed,
+              'throughput': items / elapsed if elapsed else None,
+              'peak_rss_mb': peak_rss_mb(), 'base_rss_mb': base_rss}
+    result.update(extra)
+    print json.dumps(result)
+
+def run_suite(sizes, names=None, out=None, compare=None):
+    results = []
+    for name in names or SUITE.keys():
+        for size in sizes:
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), 'case', name, str(size)])
+            result = json.loads(output.strip().splitlines()[-1])
+            results.append(result)
+            print "%-12s %8d %-6s %8.3fs %12.0f %s/sec  peak %7.1f MB" % (
+                name, size, result['unit'], result['seconds'], result['throughput'] or 0, result['unit'], result['peak_rss_mb'])
+    report = {'python': sys.version.split()[0], 'numpy': np.__version__, 'platform': platform.platform(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+    if out:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if compare:
+        with open(compare) as f:
+            old = dict(((r['bench'], r['size']), r) for r in json.load(f)['results'])
+        for result in results:
+            before = old.get((result['bench'], result['size']))
+            if before and before['throughput'] and result['throughput']:
+                print "%-12s %8d  throughput x%.2f  peak %+.1f MB" % (
+                    result['bench'], result['size'], result['throughput'] / before['throughput'],
+                    result['peak_rss_mb'] - before['peak_rss_mb'])
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for t.py")
+    parser.add_argument("bench", choices=['tokenize', 'clean', 'train', 'geo', 'live', 'score', 'suite', 'case'])
+    parser.add_argument("case", nargs='*', help="for case: NAME SIZE, one SUITE run; for suite: the cases to run (default all)")
+    parser.add_argument("--sizes", type=int, nargs='+')
+    parser.add_argument("--out", help="JSON file for the suite results")
+    parser.add_argument("--compare", help="earlier suite results to compare against")
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--sample", default=SAMPLE)
+    parser.add_argument("--rate", type=float, default=0)
+    parser.add_argument("--tweets", type=int, default=5000, help="tweets scored by score")
+    parser.add_argument("--train_tweets", type=int, default=100000, help="tweets the score model is trained on")
+    parser.add_argument("--rare_alpha", type=float, help="Pareto shape of the rare synthetic words for train and score (default 1.2 and 0.5)")
+    args = parser.parse_args()
+
+    if args.bench == 'tokenize':
+        bench_tokenize(read_sample(args.sample), args.repeat)
+    elif args.bench == 'clean':
+        bench_clean([20, 200, 2000], max(1, args.repeat // 1000))
+    elif args.bench == 'train':
+        bench_train(args.sizes or [10000, 100000, 1000000], rare_alpha=args.rare_alpha or 1.2)
+    elif args.bench == 'geo':
+        bench_geo()
+    elif args.bench == 'live':
+        bench_live(args.rate)
+    elif args.bench == 'score':
+        bench_score(args.train_tweets, args.tweets, rare_alpha=args.rare_alpha or 0.5)
+    elif args.bench == 'suite':
+        run_suite(args.sizes or [1000, 10000, 100000], args.case, args.out, args.compare)
+    elif args.bench == 'case':
+        run_case(args.case[0], int(args.case[1]))
@@ -1,42 +1,769 @@
-from bs4 import BeautifulSoup
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+
+"""
+Forum crawler. Listing pages are followed through their "page" links;
+every "/forums" link on them is a thread, whose div.msgtxt posts are
+collected. URLs go through one deduplicated Frontier and are fetched by
+a pool of threads sharing a keep-alive requests.Session, with at most
+per_host requests in flight per host and at most rate per second.
+
+    python scraper.py START_URL [--out_dir .] [--base http://host] [--workers 8] [--per_host 4] [--rate 0] [--max_pages 0] [--extractor auto]
+    python scraper.py --self_test
+    python scraper.py --bench_parse [--fixtures fixtures] [--repeat 20]
+
+In out_dir:
+posts.jsonl -- one {"url", "posts", "fetched"} line per thread, appended
+               as soon as it is extracted
+crawl.jsonl -- the frontier log; a crawl stopped halfway resumes from it
+cache/      -- the last response of every page, sent back as
+               If-None-Match/If-Modified-Since, so a re-crawl only
+               downloads and extracts new or changed threads
+--self_test crawls a Stand_In_Forum on localhost instead. --bench_parse
+times every extractor against the old full-tree parse on saved pages.
+"""
+
+import argparse
+import BaseHTTPServer
+import cgi
+import collections
+import glob
+import hashlib
+from HTMLParser import HTMLParser
 import json
+import os
+import Queue
+import re
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+
+from bs4 import BeautifulSoup, SoupStrainer
 import requests
+from requests.adapters import HTTPAdapter
+try:
+    import lxml.etree
+    import lxml.html
+except ImportError:
+    lxml = None
+
+class Soup_Extractor:
+    """
+    BeautifulSoup, but building only the elements asked for: <a href>
+    for listings, div.msgtxt for threads. parser defaults to lxml when it
+    is installed, else the pure-python html.parser.
+    """
+    link_strainer = SoupStrainer('a', href=True)
+    # A function, so "msgtxt alt" matches as it does in find_all():
+    post_strainer = SoupStrainer('div', { 'class' :lambda c: c is not None and 'msgtxt' in c.split()})
+
+    def __init__(self, parser=None):
+        self.parser = parser or ('lxml' if lxml is not None else 'html.parser')
+        self.name = 'soup/' + self.parser
+
+    def links(self, html):
+        return [a['href'] for a in BeautifulSoup(html, self.parser, parse_only=self.link_strainer).find_all('a')]
+
+    def posts(self, html):
+        """
+        Value: the inner HTML of every div.msgtxt
+        """
+        soup = BeautifulSoup(html, self.parser, parse_only=self.post_strainer)
+        return [u''.join(unicode(c) for c in div.contents) for div in soup.find_all('div', { 'class' :'msgtxt'})]
+
+class LXML_Extractor:
+    """
+    lxml's C parser and XPath. Posts are printed the way BeautifulSoup
+    prints them, so the markup t.py trains on does not depend on the
+    extractor: <br/>, attributes sorted, whitespace-only text cut to one
+    newline or space, and text and comments at the top of a post left
+    bare.
+    Where lxml repairs bad nesting differently the trees, and so the
+    posts, can still differ.
+    """
+    name = 'lxml'
+    post_xpath = "//div[contains(concat(' ', normalize-space(@class), ' '), ' msgtxt ')]"
+    # BeautifulSoup's void elements for html:
+    void_tags = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem',
+                           'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame',
+                           'image', 'isindex', 'nextid', 'spacer'])
+    keep_space_tags = frozenset(['pre', 'textarea'])
+
+    def parse(self, html):
+        try:
+            return lxml.html.fromstring(html)
+        except ValueError:
+            # Unicode with an encoding declaration:
+            return lxml.html.fromstring(html.encode('utf-8'))
+
+    def links(self, html):
+        return self.parse(html).xpath('//a/@href')
+
+    def posts(self, html):
+        return [self.inner(div, False, False) for div in self.parse(html).xpath(self.post_xpath)]
+
+    def inner(self, element, escape, keep_space):
+        parts = [self.text(element.text, escape, keep_space)]
+        for child in element:
+            if child.tag is lxml.etree.Comment and not escape:
+                # Printed as a bare string, as are the top's text nodes:
+                parts.append(child.text or u'')
+            else:
+                parts.append(self.serialize(child, keep_space))
+            parts.append(self.text(child.tail, escape, keep_space))
+        return u''.join(parts)
+
+    def text(self, text, escape, keep_space):
+        if not text:
+            return u''
+        if not keep_space and not text.strip(u' \n\t\f\r'):
+            return u'\n' if u'\n' in text else u' '
+        return cgi.escape(text) if escape else text
+
+    def serialize(self, element, keep_space=False):
+        tag = element.tag
+        if tag is lxml.etree.Comment:
+            return u'<!--%s-->' % element.text
+        if not isinstance(tag, basestring):
+            return u''
+        attrs = u''.join(u' %s=%s' % (name, self.quote(value)) for name, value in sorted(element.attrib.items()))
+        if tag in self.void_tags:
+            return u'<%s%s/>' % (tag, attrs)
+        keep_space = keep_space or tag in self.keep_space_tags
+        return u'<%s%s>%s</%s>' % (tag, attrs, self.inner(element, True, keep_space), tag)
+
+    @classmethod
+    def quote(self, value):
+        value = cgi.escape(value)
+        if '"' not in value:
+            return u'"%s"' % value
+        if "'" not in value:
+            return u"'%s'" % value
+        return u'"%s"' % value.replace('"', '&quot;')
+
+EXTRACTORS = ('auto', 'lxml', 'soup', 'soup/html.parser')
+
+def make_extractor(name='auto'):
+    """
+    'auto' is lxml when it is installed, else BeautifulSoup on html.parser.
+    """
+    if name == 'auto':
+        name = 'lxml' if lxml is not None else 'soup'
+    if name == 'lxml':
+        if lxml is None:
+            raise ValueError("the lxml extractor needs lxml installed")
+        return LXML_Extractor()
+    if name == 'soup':
+        return Soup_Extractor()
+    if name == 'soup/html.parser':
+        return Soup_Extractor('html.parser')
+    raise ValueError("unknown extractor %r" % name)
+
+class Frontier:
+    """
+    URLs still to fetch, each handed out once however often it is linked.
+    With state_path every add(), done() and failed() is appended to a log
+    there. If the log has URLs that were added but never attempted, the
+    crawl it belongs to stopped early: they are queued again and the rest
+    stays seen. URLs that failed count as attempted; they are not retried
+    and do not make the next run a resume. Otherwise the log is started
+    over for a new crawl.
+    """
+    def __init__(self, state_path=None):
+        self.queue = Queue.Queue()
+        self.seen = {}
+        self.lock = threading.Lock()
+        self.log = None
+        self.resumed = 0
+        if state_path is None:
+            return
+        done = set()
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # A line cut off by the crash:
+                        continue
+                    if event[0] == 'add':
+                        self.seen[event[2]] = event[1]
+                    else:
+                        # 'done' or 'failed':
+                        done.add(event[1])
+        pending = [(kind, url) for url, kind in self.seen.items() if url not in done]
+        if pending:
+            for item in pending:
+                self.queue.put(item)
+            self.resumed = len(pending)
+            self.log = open(state_path, 'a')
+        else:
+            self.seen = {}
+            self.log = open(state_path, 'w')
+
+    @classmethod
+    def normalize(self, url):
+        """
+        Value: url as a byte string, with the fragment dropped and non-ASCII
+        characters of the path and query percent-encoded as UTF-8 (lxml
+        hands back hrefs like /forums/caf\xe9-talk as unicode)
+        """
+        url, fragment = urlparse.urldefrag(url)
+        parts = urlparse.urlsplit(url)
+        netloc = parts.netloc.lower()
+        if isinstance(netloc, unicode):
+            netloc = netloc.encode('idna')
+        return urlparse.urlunsplit((str(parts.scheme.lower()), netloc, self.quote(parts.path or '/'),
+                                    self.quote(parts.query), ''))
+
+    @classmethod
+    def quote(self, part):
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        # Everything that is legal in a path or query already stays as it is:
+        return urllib.quote(part, safe="/?#[]@!$&'()*+,;=:%~")
+
+    def write(self, event):
+        if self.log is not None:
+            self.log.write(json.dumps(event) + '\n')
+            self.log.flush()
+
+    def add(self, url, kind):
+        """
+        Value: False if url was added before
+        """
+        url = self.normalize(url)
+        with self.lock:
+            if url in self.seen:
+                return False
+            self.seen[url] = kind
+            self.write(['add', kind, url])
+        self.queue.put((kind, url))
+        return True
+
+    def done(self, url):
+        with self.lock:
+            self.write(['done', url])
+
+    def failed(self, url):
+        with self.lock:
+            self.write(['failed', url])
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+
+    def __len__(self):
+        return len(self.seen)
+
+class HTTP_Cache:
+    """
+    The last 200 response of every URL, on disk: body and validators.
+    Entries are written to temp files and renamed into place.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return os.path.join(self.cache_dir, hashlib.sha1(url).hexdigest())
+
+    def get(self, url):
+        """
+        Value: (meta dict, body), or (None, None) when url is not cached
+        """
+        path = self.path(url)
+        try:
+            with open(path + '.json') as f:
+                meta = json.load(f)
+            with open(path + '.html', 'rb') as f:
+                return meta, f.read()
+        except (IOError, ValueError):
+            return None, None
+
+    def put(self, url, meta, body):
+        path = self.path(url)
+        # Body first, so a meta file always has its body:
+        for suffix, data in (('.html', body), ('.json', json.dumps(meta))):
+            fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_file, path + suffix)
+
+class Host_Limiter:
+    """
+    At most per_host requests in flight to a host, started at most rate
+    per second (0 for no limit).
+    """
+    def __init__(self, per_host=4, rate=0):
+        self.per_host = per_host
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.next_start = {}
+
+    def acquire(self, host):
+        with self.lock:
+            slot = self.slots.setdefault(host, threading.BoundedSemaphore(self.per_host))
+        slot.acquire()
+        if self.rate > 0:
+            with self.lock:
+                now = time.time()
+                start = max(now, self.next_start.get(host, 0))
+                self.next_start[host] = start + 1 / self.rate
+            if start > now:
+                time.sleep(start - now)
+
+    def release(self, host):
+        self.slots[host].release()
 
-url_storage = []
-url = ''
-while url != '':
-    r  = requests.get(url)
-    data = r.text
-    soup = BeautifulSoup(data)
-    for link in soup.find_all('a'):
-        l = link.get('href')
-        if l != None:
+class Forum_Crawler:
+    def __init__(self, start_url, out_dir='.', base=None, workers=8, per_host=4, rate=0, max_pages=0, timeout=30,
+                 extractor=None):
+        parts = urlparse.urlsplit(start_url)
+        # Thread links are site-relative ("/forums/..."):
+        self.base = base or "%s://%s" % (parts.scheme, parts.netloc)
+        self.workers = workers
+        self.max_pages = max_pages
+        self.timeout = timeout
+        self.extractor = extractor or make_extractor()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.limiter = Host_Limiter(per_host, rate)
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        self.cache = HTTP_Cache(os.path.join(out_dir, 'cache'))
+        self.frontier = Frontier(os.path.join(out_dir, 'crawl.jsonl'))
+        self.posts_file = open(os.path.join(out_dir, 'posts.jsonl'), 'a')
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.counts = collections.Counter()
+        self.pages = sum(kind == 'listing' for kind in self.frontier.seen.values())
+        if not self.frontier.resumed:
+            self.pages += self.frontier.add(start_url, 'listing')
+
+    def fetch(self, url):
+        """
+        Value: (page text, False if the cached copy is still current)
+        """
+        meta, body = self.cache.get(url)
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        host = urlparse.urlsplit(url).netloc
+        self.limiter.acquire(host)
+        try:
+            r = self.session.get(url, headers=headers, timeout=self.timeout)
+            if r.status_code == 304 and meta is not None:
+                return body.decode(meta['encoding'], 'replace'), False
+            r.raise_for_status()
+            encoding = r.encoding or r.apparent_encoding or 'utf-8'
+            body = r.content
+        finally:
+            self.limiter.release(host)
+        self.cache.put(url, {'url': url, 'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified'),
+                             'encoding': encoding, 'fetched': time.time()}, body)
+        return body.decode(encoding, 'replace'), True
+
+    def add_listing(self, url):
+        with self.lock:
+            if self.max_pages and self.pages >= self.max_pages:
+                return
+            self.pages += self.frontier.add(url, 'listing')
+
+    def parse_listing(self, url, html):
+        for l in self.extractor.links(html):
             if l.startswith('/forums'):
-                l = junct_prepnd + l
-                url_storage[l] = url_storage.get(l, 'place_holder_text')
+                self.frontier.add(self.base + l, 'thread')
             elif l.find('page') > -1:
-                page_link[l] = page_link.get(l, 0) + 1
-    for i, j in page_link.iteritems():
-        if j < 10
-            page_link[i] = page_link.get(i) + 8
-            url = i
-            print url
-            break
+                self.add_listing(urlparse.urljoin(url, l))
+
+    def parse_thread(self, url, html):
+        m = u''.join(self.extractor.posts(html))
+        line = json.dumps({'url': url, 'posts': m, 'fetched': time.time()}) + '\n'
+        with self.lock:
+            self.posts_file.write(line)
+            self.posts_file.flush()
+
+    def work(self):
+        while True:
+            item = self.frontier.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.stopping.is_set():
+                    # Left undone in the log for the next run:
+                    continue
+                kind, url = item
+                try:
+                    html, changed = self.fetch(url)
+                    # Unchanged listings are still read, their threads may have changed:
+                    if kind == 'listing':
+                        self.parse_listing(url, html)
+                    elif changed:
+                        self.parse_thread(url, html)
+                    self.frontier.done(url)
+                    counted = [kind, 'changed' if changed else 'unchanged']
+                except Exception as e:
+                    # Network errors, but also pages the extractor cannot
+                    # parse (lxml on an empty body): one bad URL must not
+                    # take its worker down and leave crawl() waiting.
+                    self.frontier.failed(url)
+                    counted = ['errors']
+                    print "%s: %s: %s" % (url, type(e).__name__, e)
+                with self.lock:
+                    for name in counted:
+                        self.counts[name] += 1
+            finally:
+                self.frontier.queue.task_done()
+
+    def stop(self):
+        """
+        Finishes the pages being fetched and leaves the rest for a resumed crawl.
+        """
+        self.stopping.set()
+
+    def crawl(self):
+        """
+        Value: True if every URL reachable from the start page was
+        fetched, False if stop() was called first
+        """
+        start = time.time()
+        threads = [threading.Thread(target=self.work, name="crawler-%d" % i) for i in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            # Polled rather than join()ed so Ctrl-C gets through:
+            while self.frontier.queue.unfinished_tasks:
+                time.sleep(0.05)
+        except KeyboardInterrupt:
+            self.stop()
+            self.frontier.queue.join()
+        for thread in threads:
+            self.frontier.queue.put(None)
+        for thread in threads:
+            thread.join()
+        self.frontier.close()
+        self.posts_file.close()
+        self.session.close()
+        self.elapsed = time.time() - start
+        return not self.stopping.is_set()
+
+    def report(self):
+        fetched = self.counts['listing'] + self.counts['thread']
+        return "%d listing pages, %d threads (%d changed, %d not modified), %d errors in %.2fs (%.1f pages/sec)%s" % (
+            self.counts['listing'], self.counts['thread'], self.counts['changed'], self.counts['unchanged'],
+            self.counts['errors'], self.elapsed, fetched / self.elapsed if self.elapsed else 0,
+            ", resumed %d pending" % self.frontier.resumed if self.frontier.resumed else "")
+
+class Stand_In_Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.delay)
+            body = server.page(self.path)
+        finally:
+            with server.lock:
+                server.active -= 1
+        etag = '"%s"' % hashlib.md5(body).hexdigest() if body is not None else None
+        if body is None:
+            status, body = 404, 'not found'
+        elif etag == self.headers.get('If-None-Match'):
+            status, body = 304, ''
         else:
-            url = ''
-with open('data.txt', 'w') as outfile:
-    json.dump(url_storage, outfile)
-
-for k, l in url_storage.iteritems():
-    if l == 'place_holder_text':
-        m = ''
-        r  = requests.get(k)
-        data = r.text
-        soup = BeautifulSoup(data)
+            status = 200
+        server.count((urlparse.urlsplit(self.path).path + '?' + urlparse.urlsplit(self.path).query, status))
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class Stand_In_Forum(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local forum for --self_test: listing pages /forum?page=1..pages,
+    each linking the next two pages and threads_per_page threads (some
+    twice, some from the page before), every response delay seconds late.
+    Pages carry an ETag and answer a matching If-None-Match with 304;
+    edit() changes a thread, as a new reply would; threads listed in
+    missing answer 404 and those in empty an empty page.
+    """
+    daemon_threads = True
+
+    def __init__(self, pages=5, threads_per_page=20, delay=0.02):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Stand_In_Handler)
+        self.pages = pages
+        self.threads_per_page = threads_per_page
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.replies = collections.Counter()
+        self.missing = set()
+        self.empty = set()
+        self.active = 0
+        self.max_active = 0
+
+    def count(self, key):
+        with self.lock:
+            self.requests[key] += 1
+
+    def fetches(self, status, prefix=''):
+        """
+        Value: how many responses with status went to paths starting with prefix
+        """
+        return sum(count for key, count in self.requests.items()
+                   if key != 'connections' and key[1] == status and key[0].startswith(prefix))
+
+    def edit(self, i):
+        self.replies[i] += 1
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def thread_ids(self, page):
+        first = (page - 1) * self.threads_per_page
+        # Overlaps the page before, as listings shift while they are crawled:
+        return range(max(first - 2, 0), first + self.threads_per_page)
+
+    def page(self, path):
+        parts = urlparse.urlsplit(path)
+        if parts.path == '/forum':
+            page = int(urlparse.parse_qs(parts.query).get('page', ['1'])[0])
+            if not 1 <= page <= self.pages:
+                return None
+            links = ['<a href="/forums/thread/%d#post1">thread %d</a>' % (i, i) for i in self.thread_ids(page)]
+            links += ['<a href="/forums/thread/%d">again</a>' % i for i in self.thread_ids(page)[:3]]
+            links += ['<a href="/forum?page=%d">page %d</a>' % (p, p) for p in (page + 1, page + 2) if p <= self.pages]
+            links += ['<a>no href</a>', '<a href="/about">about</a>']
+            return "<html><body>%s</body></html>" % "\n".join(links)
+        if parts.path.startswith('/forums/thread/'):
+            i = int(parts.path.rsplit('/', 1)[1])
+            if i in self.missing:
+                return None
+            if i in self.empty:
+                return ''
+            return "<html><body>%s</body></html>" % "".join(self.thread_posts(i))
+        return None
+
+    def thread_posts(self, i):
+        posts = ['<div class="msgtxt">post %d <b>one</b></div>' % i, '<div class="msgtxt">post %d two</div>' % i]
+        posts += ['<div class="msgtxt">reply %d</div>' % r for r in range(self.replies[i])]
+        return posts
+
+    def expected_posts(self):
+        ids = set()
+        for page in range(1, self.pages + 1):
+            ids.update(self.thread_ids(page))
+        return dict(("%s/forums/thread/%d" % (self.url, i),
+                     u"".join(post[len('<div class="msgtxt">'):-len('</div>')] for post in self.thread_posts(i)))
+                    for i in ids)
+
+def read_posts(out_dir):
+    """
+    Value: thread URL -> the posts of its latest posts.jsonl line
+    """
+    posts = {}
+    with open(os.path.join(out_dir, 'posts.jsonl')) as f:
+        for line in f:
+            record = json.loads(line)
+            posts[record['url']] = record['posts']
+    return posts
+
+def self_test(workers=8, per_host=4):
+    # lxml hands back non-ASCII hrefs as unicode; the cache hashes bytes:
+    url = Frontier.normalize(u'http://Forum.example/forums/caf\xe9-talk?q=na\xefve#post1')
+    assert url == 'http://forum.example/forums/caf%C3%A9-talk?q=na%C3%AFve', url
+    assert Frontier.normalize(url) == url
+    server = Stand_In_Forum()
+    threading.Thread(target=server.serve_forever).start()
+    out_dirs = []
+    try:
+        start_url = server.url + "/forum?page=1"
+        results = {}
+        for w in (1, workers):
+            server.requests.clear()
+            server.max_active = 0
+            out_dirs.append(tempfile.mkdtemp())
+            crawler = Forum_Crawler(start_url, out_dirs[-1], workers=w, per_host=per_host)
+            assert crawler.crawl()
+            print "%d workers: %s, %d connections, %d max in flight" % (
+                w, crawler.report(), server.requests['connections'], server.max_active)
+            assert read_posts(out_dirs[-1]) == server.expected_posts()
+            assert all(count == 1 for key, count in server.requests.items() if key != 'connections')
+            assert server.max_active <= min(w, per_host)
+            assert server.requests['connections'] <= w
+            results[w] = crawler.elapsed
+        print "speedup with %d workers: %.1fx" % (workers, results[1] / results[workers])
+
+        # A crawl stopped halfway, then resumed: no thread is downloaded twice.
+        server.requests.clear()
+        out_dirs.append(tempfile.mkdtemp())
+        crawler = Forum_Crawler(start_url, out_dirs[-1], workers=workers, per_host=per_host)
+        stopper = threading.Timer(0.3, crawler.stop)
+        stopper.start()
+        finished = crawler.crawl()
+        stopper.cancel()
+        print "stopped: %s" % crawler.report()
+        crawler = Forum_Crawler(start_url, out_dirs[-1], workers=workers, per_host=per_host)
+        assert crawler.crawl()
+        print "resumed: %s" % crawler.report()
+        assert finished or crawler.frontier.resumed
+        assert read_posts(out_dirs[-1]) == server.expected_posts()
+        assert server.fetches(200, '/forums/') == len(server.expected_posts())
+        assert server.fetches(304) == 0
+
+        # A re-crawl after two threads got replies and a page of new threads appeared.
+        server.requests.clear()
+        server.edit(3)
+        server.edit(30)
+        old = set(server.expected_posts())
+        server.pages += 1
+        new = set(server.expected_posts()) - old
+        lines = sum(1 for line in open(os.path.join(out_dirs[-1], 'posts.jsonl')))
+        crawler = Forum_Crawler(start_url, out_dirs[-1], workers=workers, per_host=per_host)
+        assert crawler.crawl()
+        print "re-crawl: %s" % crawler.report()
+        assert read_posts(out_dirs[-1]) == server.expected_posts()
+        assert server.fetches(200, '/forums/') == 2 + len(new)
+        assert sum(1 for line in open(os.path.join(out_dirs[-1], 'posts.jsonl'))) == lines + 2 + len(new)
+
+        # Threads that fail are logged as such: the next crawl is not a resume.
+        # lxml will not parse the empty one at all.
+        server.missing.add(7)
+        server.empty.add(8)
+        out_dirs.append(tempfile.mkdtemp())
+        crawler = Forum_Crawler(start_url, out_dirs[-1], workers=workers, per_host=per_host)
+        assert crawler.crawl()
+        print "with a missing and an empty thread: %s" % crawler.report()
+        assert crawler.counts['errors'] == 1 + isinstance(crawler.extractor, LXML_Extractor)
+        assert not Forum_Crawler(start_url, out_dirs[-1], workers=workers, per_host=per_host).frontier.resumed
+        server.missing.clear()
+        server.empty.clear()
+        print "self test passed"
+    finally:
+        server.shutdown()
+        server.server_close()
+        for out_dir in out_dirs:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+class Legacy_Extractor:
+    """
+    What crawls used to do: a full html.parser tree per page, and posts
+    built up with +=.
+    """
+    name = 'full tree (old)'
+
+    def links(self, html):
+        soup = BeautifulSoup(html, 'html.parser')
+        return [link.get('href') for link in soup.find_all('a') if link.get('href') is not None]
+
+    def posts(self, html):
+        soup = BeautifulSoup(html, 'html.parser')
+        posts = []
         for div in soup.find_all('div', { 'class' :'msgtxt'}):
+            m = u''
             for c in div.contents:
                 m += unicode(c)
-            print c
-            url_storage[k] = m
-with open('posts.txt', 'w') as outfile:
-    json.dump(url_storage, outfile)
+            posts.append(m)
+        return posts
+
+unescape = HTMLParser().unescape
+
+def post_text(post):
+    """
+    A post with its markup dropped and whitespace collapsed, to compare
+    extractors that serialize tags differently.
+    """
+    return u' '.join(unescape(re.sub(r'<[^>]*>', u' ', post)).split())
+
+def bench_parse(fixture_dir, repeat=20):
+    """
+    Links are pulled from listing_*.html and posts from every other
+    fixture, as the crawler does.
+    """
+    pages = []
+    for path in sorted(glob.glob(os.path.join(fixture_dir, '*.html'))):
+        with open(path) as f:
+            pages.append((os.path.basename(path).startswith('listing'), f.read().decode('utf-8')))
+    size = sum(len(html.encode('utf-8')) for listing, html in pages)
+    legacy = Legacy_Extractor()
+    extract = lambda extractor, listing, html: extractor.links(html) if listing else extractor.posts(html)
+    reference = [extract(legacy, listing, html) for listing, html in pages]
+    extractors = [legacy]
+    for name in EXTRACTORS[1:]:
+        try:
+            extractors.append(make_extractor(name))
+        except ValueError as e:
+            print "%-18s skipped: %s" % (name, e)
+    print "%d fixture pages, %.0f KB, %d posts" % (len(pages), size / 1024, sum(len(r) for (listing, html), r in zip(pages, reference) if not listing))
+    results = {}
+    for extractor in extractors:
+        start = time.time()
+        for i in range(repeat):
+            extracted = [extract(extractor, listing, html) for listing, html in pages]
+        elapsed = time.time() - start
+        links = sum(got == ref for (listing, html), got, ref in zip(pages, extracted, reference) if listing)
+        posts = [(a, b) for (listing, html), got, ref in zip(pages, extracted, reference) if not listing
+                 for a, b in map(None, got, ref)]
+        exact = sum(a == b for a, b in posts)
+        text = sum(a is not None and b is not None and post_text(a) == post_text(b) for a, b in posts)
+        results[extractor.name] = len(pages) * repeat / elapsed
+        print "%-18s %7.1f pages/sec %6.2f MB/sec %5.1fx  links %d/%d pages  posts exact %d/%d, text %d/%d" % (
+            extractor.name, results[extractor.name], size * repeat / elapsed / 2 ** 20, results[extractor.name] / results[legacy.name],
+            links, sum(listing for listing, html in pages), exact, len(posts), text, len(posts))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Concurrent forum crawler")
+    parser.add_argument("url", nargs='?', default='', help="first listing page")
+    parser.add_argument("--out_dir", default='.', help="where posts.jsonl, crawl.jsonl and the cache go")
+    parser.add_argument("--base", help="prefix for /forums links (default: scheme and host of url)")
+    parser.add_argument("--workers", type=int, default=8, help="fetching threads")
+    parser.add_argument("--per_host", type=int, default=4, help="requests in flight per host")
+    parser.add_argument("--rate", type=float, default=0, help="requests per second per host (0 for no limit)")
+    parser.add_argument("--max_pages", type=int, default=0, help="listing pages to follow (0 for all)")
+    parser.add_argument("--extractor", choices=EXTRACTORS, default='auto', help="how links and posts are pulled out of pages")
+    parser.add_argument("--self_test", action="store_true", help="crawl a local stand-in forum and check the result")
+    parser.add_argument("--bench_parse", action="store_true", help="time the extractors on the saved pages in --fixtures")
+    parser.add_argument("--fixtures", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures'))
+    parser.add_argument("--repeat", type=int, default=20, help="passes over the fixtures for --bench_parse")
+    args = parser.parse_args()
+
+    if args.self_test:
+        self_test(args.workers, args.per_host)
+    elif args.bench_parse:
+        bench_parse(args.fixtures, args.repeat)
+    elif args.url != '':
+        crawler = Forum_Crawler(args.url, args.out_dir, args.base, args.workers, args.per_host, args.rate, args.max_pages,
+                                extractor=make_extractor(args.extractor))
+        crawler.crawl()
+        print crawler.report()
@@ -22,7 +22,9 @@ this:
 
 3. The tokenization is done by word_re.findall(s), where s is the
    user-supplied string, inside the tokenize() method of the class
-   Tokenizer.
+   Tokenizer. tokenize() now scans tagged_word_re instead, which has
+   the same alternatives as named groups, so each token comes back
+   with its type (tokenize_tagged() returns the (token, type) pairs).
 
 4. When instantiating Tokenizer objects, there is a single option:
    preserve_case.  By default, it is set to True. If it is set to
@@ -48,23 +50,48 @@ __email__ = "See the author's website"
 ######################################################################
 
 import argparse
+import array
+import atexit
+import bisect
+import bz2
 import codecs
 import collections
 from collections import defaultdict
+import cProfile
 import csv
 import getopt
+import hashlib
 import htmlentitydefs
+import heapq
+import itertools
 import json
+import math
+import mmap
+import multiprocessing
 import operator
 import os
 from os import listdir
 from os.path import isfile, join
+import pstats
+import Queue
 import re
+import resource
+import shutil
+import struct
 import sys
+import tempfile
+import threading
 import time
+import zlib
+import numpy as np
 from tweepy.streaming import StreamListener
 from tweepy import OAuthHandler
 from tweepy import Stream
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2.7 has it only as the pytracemalloc patch; --profile then snapshots RSS alone.
+    tracemalloc = None
 
 ######################################################################
 # The following strings are components in the regular expression
@@ -167,6 +194,18 @@ url_re = re.compile(regex_strings[5], re.VERBOSE | re.I | re.UNICODE)
 apo_dash_re = re.compile(regex_strings[6], re.VERBOSE | re.I | re.UNICODE)
 num_re = re.compile(regex_strings[6], re.VERBOSE | re.I | re.UNICODE)
 
+# Single-pass tokenizing regex: the same alternatives, in the same order,
+# each wrapped in a named group so the match itself tells us the token type.
+token_types = ('phone', 'emoticon', 'tag', 'username', 'hashtag', 'url', 'apo_dash', 'num', 'word')
+tagged_word_re = re.compile("|".join("(?P<%s>%s)" % (name, regex) for name, regex in zip(token_types, regex_strings)), re.VERBOSE | re.I | re.UNICODE)
+
+# replace_special() uses search(), so a token of another type that merely
+# contains an emoticon (an '8)' in a phone number, '8:30', '@bd8') is tagged
+# as an emoticon. An emoticon always has one of these eye characters, so only
+# tokens containing one need the extra regex check.
+emoticon_eyes = frozenset(u":;=8")
+special_names = { 'url':"url ", 'emoticon':"emoticon ", 'username':"username ", 'hashtag':"hashtag " }
+
 # These are for regularizing HTML entities to Unicode:
 html_entity_digit_re = re.compile(r"&#\d+;")
 html_entity_alpha_re = re.compile(r"&\w+;")
@@ -175,46 +214,374 @@ amp = "&amp;"
 # This is for stripping cruft from words
 punct_string_re = re.compile(punct_string, re.VERBOSE | re.I | re.UNICODE)
 
+# Data files shipped next to this script (clean_rules.txt):
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
 ######################################################################
 # These are Geolocation codes
 Geo = ['USA', 'Alabama', 'AL', 'Alaska', 'AK', 'Arizona', 'AZ', 'Arkansas', 'AR', 'California', 'CA', 'Colorado', 'CO', 'Connecticut', 'CT', 'Delaware', 'DE', 'Florida', 'FL', 'Georgia', 'GA', 'Hawaii', 'HI', 'Idaho', 'ID', 'Illinois', 'IL', 'Indiana', 'IN', 'Iowa', 'IA', 'Kansas', 'KS', 'Kentucky', 'KY', 'Louisiana', 'LA', 'Maine', 'ME', 'Maryland', 'MD', 'Massachusetts', 'MA', 'Michigan', 'MI', 'Minnesota', 'MN', 'Mississippi', 'MS', 'Missouri', 'MO', 'Montana', 'MT', 'Nebraska', 'NE', 'Nevada', 'NV', 'New Hampshire', 'NH', 'New Jersey', 'NJ', 'New Mexico', 'NM', 'New York', 'NY', 'North Carolina', 'NC', 'North Dakota', 'ND', 'Ohio', 'OH', 'Oklahoma', 'OK', 'Oregon', 'OR', 'Pennsylvania', 'PA', 'Rhode Island', 'RI', 'South Carolina', 'SC', 'South Dakota', 'SD', 'Tennessee', 'TN', 'Texas', 'TX', 'Utah', 'UT', 'Vermont', 'VT', 'Virginia', 'VA', 'Washington', 'WA', 'West Virginia', 'WV', 'Wisconsin', 'WI', 'Wyoming', 'WY', 'Chicago', 'DC', 'Los Angeles']
 
-Stop_List = []
+# Stop words, as a set so filtering a token is a hash lookup:
+Stop_List = frozenset()
 
 METHOD_NAME = { 'PARSE':0, 'TOKENIZE':1, 'SPLIT':2, 'COUNT':3, 'HASH':4, 'REPLACE':5 }
 
+class Null_Stage:
+    """
+    What Stage_Profiler.stage() returns while profiling is off.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, items):
+        pass
+
+NULL_STAGE = Null_Stage()
+
+class Profiled_Stage:
+    def __init__(self, profiler, name, items):
+        self.profiler = profiler
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.profiler.enter(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.exit(self, time.time() - self.start)
+        return False
+
+    def add(self, items):
+        self.items += items
+
+class Stage_Profiler:
+    """
+    Wall time, calls and items per pipeline stage for --profile. Stages
+    nest; "self" is a stage's time less the stages inside it, so
+    "tokenize" around a Corpus does not count the "read" it pulls. Off
+    by default, where stage() and iterate() hand back shared no-ops.
+    Pool workers send their stages back with run_profiled(), so with
+    --workers the stage times add up across processes and can exceed
+    the wall time.
+
+    sample_every -- cProfile one in that many calls of each stage, at any
+                    depth, in the main thread; a stage inside one being
+                    sampled is already covered and is not counted
+    snapshot_every -- seconds between memory snapshots (tracemalloc
+                      top allocations when it is installed, RSS always)
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.stages = collections.OrderedDict()
+        self.snapshots = []
+        self.started = time.time()
+        self.last_snapshot = self.started
+        self.sample_calls = collections.Counter()
+        self.sampled = collections.Counter()
+        self.sampling = False
+
+    def start(self, sample_every=0, snapshot_every=0):
+        self.enabled = True
+        self.sample_every = sample_every
+        self.snapshot_every = snapshot_every
+        self.cprofile = cProfile.Profile() if sample_every > 0 else None
+        if snapshot_every > 0 and tracemalloc is not None:
+            tracemalloc.start()
+        self.reset()
+        return self
+
+    def stage(self, name, items=0):
+        if not self.enabled:
+            return NULL_STAGE
+        return Profiled_Stage(self, name, items)
+
+    def iterate(self, name, iterable):
+        """
+        Times each next() of iterable as stage name, counting one item per value.
+        """
+        if not self.enabled:
+            return iterable
+        return self.timed_iter(name, iterable)
+
+    def timed_iter(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name, 1) as stage:
+                try:
+                    value = next(iterator)
+                except StopIteration:
+                    stage.items = 0
+                    return
+            yield value
+
+    def enter(self, stage):
+        stack = self.local.__dict__.setdefault('stack', [])
+        stage.child = 0.0
+        stage.sampled = False
+        # cProfile only sees the thread it was enabled in, and cannot nest:
+        if self.cprofile is not None and not self.sampling and threading.current_thread().name == 'MainThread':
+            self.sample_calls[stage.name] += 1
+            if self.sample_calls[stage.name] % self.sample_every == 0:
+                stage.sampled = self.sampling = True
+                self.sampled[stage.name] += 1
+                self.cprofile.enable()
+        stack.append(stage)
+
+    def exit(self, stage, seconds):
+        stack = self.local.stack
+        stack.pop()
+        if stage.sampled:
+            self.cprofile.disable()
+            self.sampling = False
+        if stack:
+            stack[-1].child += seconds
+        with self.lock:
+            stats = self.stages.get(stage.name)
+            if stats is None:
+                stats = self.stages[stage.name] = {'calls': 0, 'seconds': 0.0, 'self_seconds': 0.0, 'items': 0}
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['self_seconds'] += seconds - stage.child
+            stats['items'] += stage.items
+        if self.snapshot_every > 0 and time.time() - self.last_snapshot >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        self.last_snapshot = time.time()
+        snap = {'time': self.last_snapshot - self.started,
+                'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            snap['top'] = [{'where': str(stat.traceback), 'size_kb': stat.size / 1024, 'count': stat.count}
+                           for stat in tracemalloc.take_snapshot().statistics('lineno')[:10]]
+        with self.lock:
+            self.snapshots.append(snap)
+
+    def take(self):
+        """
+        Value: the stage totals so far, which are then cleared
+        """
+        with self.lock:
+            stages, self.stages = self.stages, collections.OrderedDict()
+        return stages
+
+    def merge(self, stages):
+        with self.lock:
+            for name, other in stages.items():
+                stats = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'self_seconds': 0.0, 'items': 0})
+                for key in stats:
+                    stats[key] += other[key]
+
+    def report(self):
+        wall = time.time() - self.started
+        stages = collections.OrderedDict()
+        for name, stats in self.stages.items():
+            stats = dict(stats)
+            stats['items_per_sec'] = stats['items'] / stats['seconds'] if stats['seconds'] else None
+            stats['share'] = stats['self_seconds'] / wall if wall else None
+            stages[name] = stats
+        report = {'wall_seconds': wall, 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  'stages': stages, 'snapshots': self.snapshots}
+        # Empty when no sample was taken (fewer calls than sample_every, or
+        # stages only in worker threads), and pstats will not read that:
+        if self.cprofile is not None and self.cprofile.getstats():
+            stats = pstats.Stats(self.cprofile)
+            top = sorted(stats.stats.items(), key=lambda item: -item[1][3])[:30]
+            report['cprofile'] = {'sampled_calls': dict(self.sampled),
+                                  'top_cumulative': [{'function': "%s:%d(%s)" % func, 'calls': nc, 'tottime': tt, 'cumtime': ct}
+                                                     for func, (cc, nc, tt, ct, callers) in top]}
+        return report
+
+    def write(self, path):
+        report = self.report()
+        with open(os.path.expanduser(path), 'w') as f:
+            json.dump(report, f, indent=2)
+        print >> sys.stderr, "%-16s %8s %10s %10s %12s %7s" % ('stage', 'calls', 'seconds', 'self', 'items/sec', 'share')
+        for name, stats in report['stages'].items():
+            print >> sys.stderr, "%-16s %8d %10.3f %10.3f %12.0f %6.1f%%" % (
+                name, stats['calls'], stats['seconds'], stats['self_seconds'], stats['items_per_sec'] or 0, 100 * (stats['share'] or 0))
+        print >> sys.stderr, "wall %.3fs, peak RSS %.1f MB, report in %s" % (report['wall_seconds'], report['peak_rss_mb'], path)
+
+profiler = Stage_Profiler()
+
+def run_profiled(job):
+    """
+    Pool wrapper: job is (function, argument). While profiling, the
+    worker's stage totals come back with the result for merge_profiled().
+    """
+    fn, arg = job
+    if not profiler.enabled:
+        return fn(arg), None
+    profiler.take()
+    result = fn(arg)
+    return result, profiler.take()
+
+def merge_profiled(results):
+    for result, stages in results:
+        if stages:
+            profiler.merge(stages)
+        yield result
+
+class LRU_Cache:
+    """
+    Bounded least-recently-used cache keyed on the raw text. It keeps at
+    most max_size entries and never stores texts longer than max_key_len,
+    so its memory stays flat however long a --live_tweet run goes.
+    """
+    def __init__(self, max_size=10000, max_key_len=1000):
+        self.max_size = max_size
+        self.max_key_len = max_key_len
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # Re-insert so the key becomes the most recently used:
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.max_size <= 0 or len(key) > self.max_key_len:
+            return
+        if key in self.data:
+            del self.data[key]
+        elif len(self.data) >= self.max_size:
+            self.data.popitem(last=False)
+            self.evictions += 1
+        self.data[key] = value
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return { 'size':len(self.data), 'max_size':self.max_size, 'hits':self.hits, 'misses':self.misses,
+                 'evictions':self.evictions, 'hit_rate':self.hits / lookups if lookups else 0.0 }
+
 class Tokenizer:
-    def __init__(self, preserve_case=False):
+    def __init__(self, preserve_case=False, debug=False, cache_size=0):
         self.preserve_case = preserve_case
+        self.debug = debug
+        # Memoizes tokenize_tagged() for repeated texts (retweets, spam, boilerplate).
+        # Entries are not invalidated, so load the stop words before tokenizing.
+        self.cache = LRU_Cache(cache_size) if cache_size > 0 else None
 
     def tokenize(self, s):
         """
         Argument: s -- any string or unicode object
         Value: a tokenize list of strings; conatenating this list returns the original string if preserve_case=False
         """        
-        # Try to ensure unicode:
-        try:
-            s = unicode(s)
-        except UnicodeDecodeError:
-            s = str(s).encode('string_escape')
-            s = unicode(s)
-        # Fix HTML character entitites:
-        s = self.__html2unicode(s)
-        # Tokenize:
-        words = word_re.findall(s)
-        #print "SSSS"
-        # Possible alter the case, but avoid changing emoticons like :D into :d:
-        if not self.preserve_case:
-          words = map(lambda x : self.replace_special(x), words)
-        words = filter((lambda x : x not in Stop_List), words)
-        print words
-        return words
+        return next(self.tokenize_many((s,)))
+
+    def tokenize_many(self, iterable):
+        """
+        Argument: iterable -- strings or unicode objects, e.g. an open file
+        Value: a generator yielding one tokenize() list per document
+        """
+        debug = self.debug
+        for pairs in self.tokenize_tagged_many(iterable):
+            words = [word for word, kind in pairs]
+            if debug:
+                print words
+            yield words
+
+    def tokenize_tagged(self, s):
+        """
+        Argument: s -- any string or unicode object
+        Value: a list of (token, type) pairs from a single scan of tagged_word_re;
+        with preserve_case=False the tokens are the same normalized strings tokenize() returns
+        """
+        return next(self.tokenize_tagged_many((s,)))
+
+    def tokenize_tagged_many(self, iterable):
+        """
+        Argument: iterable -- strings or unicode objects
+        Value: a generator yielding one tokenize_tagged() list per document;
+        lookups are bound once here rather than once per document
+        """
+        finditer = tagged_word_re.finditer
+        html2unicode = self.__html2unicode
+        normalize = self.normalize_tagged
+        preserve_case = self.preserve_case
+        stop_list = Stop_List
+        cache = self.cache
+        for s in iterable:
+            if cache is not None:
+                pairs = cache.get(s)
+                if pairs is not None:
+                    yield list(pairs)
+                    continue
+                key = s
+            # Try to ensure unicode:
+            try:
+                s = unicode(s)
+            except UnicodeDecodeError:
+                s = str(s).encode('string_escape')
+                s = unicode(s)
+            s = html2unicode(s)
+            pairs = []
+            for m in finditer(s):
+                word = m.group()
+                kind = m.lastgroup
+                if not preserve_case:
+                    word, kind = normalize(word, kind)
+                if word not in stop_list:
+                    pairs.append((word, kind))
+            if cache is not None:
+                cache.put(key, tuple(pairs))
+            yield pairs
+
+    def normalize_tagged(self, word, kind):
+        """
+        Same result as replace_special(), but starts from the type the
+        single-pass match already found instead of re-running every regex.
+        """
+        if kind == 'tag':
+            kind = self.special_type(word) or kind
+        elif kind not in ('url', 'emoticon', 'apo_dash'):
+            if not emoticon_eyes.isdisjoint(word) and emoticon_re.search(word):
+                kind = 'emoticon'
+        if kind in special_names:
+            return special_names[kind], kind
+        if u',' in word:
+            word = word.replace(u',', u' ')
+        return word.lower(), kind
+
+    def special_type(self, word):
+        if url_re.search(word):
+            return 'url'
+        elif emoticon_re.search(word):
+            return 'emoticon'
+        elif username_re.search(word):
+            return 'username'
+        elif hashtag_re.search(word):
+            return 'hashtag'
+        return None
 
     def __html2unicode(self, s):
         """
         Internal method that seeks to replace all the HTML entities in
         s with their corresponding unicode characters.
         """
+        # Every entity starts with '&'; most tweets have none at all:
+        if u'&' not in s:
+            return s
         # First the digits:
         ents = set(html_entity_digit_re.findall(s))
         if len(ents) > 0:
@@ -223,7 +590,8 @@ class Tokenizer:
                 try:
                     entnum = int(entnum)
                     s = s.replace(ent, unichr(entnum))	
-                except:
+                except (ValueError, OverflowError):
+                    # Not a number, or past the narrow build's unichr range
                     pass
         # Now the alpha versions:
         ents = set(html_entity_alpha_re.findall(s))
@@ -232,20 +600,15 @@ class Tokenizer:
             entname = ent[1:-1]
             try:            
                 s = s.replace(ent, unichr(htmlentitydefs.name2codepoint[entname]))
-            except:
+            except KeyError:
                 pass                    
             s = s.replace(amp, " and ")
         return s
        
     def replace_special(self, word):
-        if url_re.search(word):
-            word = "url " #+ word
-        elif emoticon_re.search(word):
-            word = "emoticon " # +word (for testing)
-        elif username_re.search(word):
-            word = "username " #+ word
-        elif hashtag_re.search(word):
-            word = "hashtag " #+ word
+        kind = self.special_type(word)
+        if kind:
+            word = special_names[kind]
             
         word = re.sub(",", " ", word)
         return word.lower()
@@ -254,11 +617,424 @@ class Tokenizer:
     def read_stopword_list(self, file_name='en.txt', root_dir='~/twitter/test_data/StopwordsList'):     
         with open(os.path.join(os.path.expanduser(root_dir), file_name)) as f:
             global Stop_List 
-            Stop_List = [line.rstrip() for line in f]
+            Stop_List = frozenset(line.rstrip() for line in f)
+
+# array typecode for packed keys and counts, which need 8 bytes: Python 2
+# has no 'q', and 'l' is only 8 bytes where C longs are (not on Windows).
+INT64 = 'l' if array.array('l').itemsize == 8 else None
+
+def int64_array(values=()):
+    if INT64 is None:
+        raise OverflowError("packed n-gram keys need 64 bit array items, and this platform's C long is 32 bits")
+    return array.array(INT64, values)
+
+class Vocabulary:
+    """
+    Maps tokens to small integer ids (and back), so n-grams can be stored
+    as packed integers instead of "a_b_c" strings.
+    """
+    # Bits per token id in a packed n-gram key; three ids fill a 64 bit array slot.
+    ID_BITS = 21
+    MAX_SIZE = 1 << ID_BITS
+
+    def __init__(self):
+        self.ids = {}
+        self.tokens = []
+
+    def add(self, token):
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = len(self.tokens)
+            if token_id >= self.MAX_SIZE:
+                raise OverflowError("vocabulary is limited to %d tokens" % self.MAX_SIZE)
+            self.ids[token] = token_id
+            self.tokens.append(token)
+        return token_id
+
+    def get(self, token):
+        return self.ids.get(token)
+
+    def token(self, token_id):
+        return self.tokens[token_id]
+
+    def ids_of(self, tokens):
+        """
+        Ids of a list of tokens, -1 for unknown ones.
+        """
+        get = self.ids.get
+        return [get(token, -1) for token in tokens]
+
+    def __len__(self):
+        return len(self.tokens)
+
+class NGram_Store:
+    """
+    Counts for n-grams of one order, keyed by the packed ids of their tokens.
+    Counting goes into a dict of ints; freeze() moves the counts into two
+    sorted arrays (8 bytes per key and per count) searched with bisect.
+
+    Lookups take token tuples, as built by NGram_Helpers.build_ngram_tuples,
+    or the old "a_b_c" strings, so the scoring code can use a store like the
+    dicts read from the JSON model files.
+    """
+    def __init__(self, n, vocab=None):
+        self.n = n
+        self.vocab = vocab if vocab is not None else Vocabulary()
+        self.counts = {}
+        self.key_array = None
+        self.count_array = None
+
+    @classmethod
+    def from_dict(self, d, n, vocab=None):
+        """
+        Keys that split plainly into n tokens go first, so their tokens are
+        known when the keys of tokens with '_' in them are cut.
+        """
+        store = self(n, vocab)
+        unclear = []
+        for key, count in d.iteritems():
+            if key.count("_") == n - 1:
+                store.add(tuple(key.split("_")), count)
+            else:
+                unclear.append((key, count))
+        for key, count in unclear:
+            gram = store.split_key(key, add=True)
+            if gram is not None:
+                store.add(gram, count)
+        return store.freeze()
+
+    def pack(self, ids):
+        key = 0
+        for token_id in ids:
+            if token_id is None:
+                return None
+            key = (key << Vocabulary.ID_BITS) | token_id
+        return key
+
+    def unpack(self, key):
+        """
+        Tokens of a packed key; the vocabulary may be a Binary_Model.
+        """
+        mask = Vocabulary.MAX_SIZE - 1
+        token = self.vocab.token
+        # int(): keys of a Mapped_NGram_Store are numpy integers
+        key = int(key)
+        ids = []
+        for i in range(self.n):
+            ids.append(token(key & mask))
+            key >>= Vocabulary.ID_BITS
+        return tuple(reversed(ids))
+
+    def split_key(self, key, add=False):
+        """
+        Turns an "a_b_c" string into a token tuple. Tokens may contain '_'
+        themselves, so when the plain split does not give n tokens every way
+        of cutting the string at n-1 of its underscores is tried, and the
+        first cut made of known tokens wins (File_Utils.read_model loads the
+        unigrams first). With add=True the first cut is used when none is
+        fully known.
+        """
+        parts = key.split("_")
+        if len(parts) == self.n:
+            return tuple(parts)
+        first = None
+        for cuts in itertools.combinations(range(1, len(parts)), self.n - 1):
+            bounds = (0,) + cuts + (len(parts),)
+            tokens = tuple("_".join(parts[a:b]) for a, b in zip(bounds, bounds[1:]))
+            if all(self.vocab.get(token) is not None for token in tokens):
+                return tokens
+            if first is None:
+                first = tokens
+        return first if add else None
+
+    def key_of(self, gram):
+        if isinstance(gram, basestring):
+            gram = self.split_key(gram)
+            if gram is None:
+                return None
+        return self.pack([self.vocab.get(token) for token in gram])
+
+    def count_ids(self, ids):
+        """
+        Counts every n-gram in a sequence of token ids (one padded sample).
+        """
+        if self.key_array is not None:
+            raise ValueError("NGram_Store is frozen")
+        keys = ids[:len(ids) - self.n + 1]
+        for j in range(1, self.n):
+            keys = [(key << Vocabulary.ID_BITS) | token_id for key, token_id in zip(keys, ids[j:])]
+        counts = self.counts
+        for key in keys:
+            counts[key] = counts.get(key, 0) + 1
+
+    def add(self, gram, count=1):
+        if self.key_array is not None:
+            raise ValueError("NGram_Store is frozen")
+        key = self.pack([self.vocab.add(token) for token in gram])
+        self.counts[key] = self.counts.get(key, 0) + count
+
+    def merge(self, other, id_map=None):
+        """
+        Adds the counts of another store of the same order, e.g. one built
+        by a training worker with its own Vocabulary. id_map maps the other
+        vocabulary's ids to ours; it is built here when not given.
+        """
+        if id_map is None:
+            id_map = [self.vocab.add(token) for token in other.vocab.tokens]
+        self.thaw()
+        counts = self.counts
+        mask = Vocabulary.MAX_SIZE - 1
+        shifts = [Vocabulary.ID_BITS * i for i in reversed(range(self.n))]
+        for key, count in other.packed_items():
+            new_key = 0
+            for shift in shifts:
+                new_key = (new_key << Vocabulary.ID_BITS) | id_map[(key >> shift) & mask]
+            counts[new_key] = counts.get(new_key, 0) + count
+        return self
+
+    def thaw(self):
+        if self.key_array is not None:
+            self.counts = dict(itertools.izip(self.key_array, self.count_array))
+            self.key_array = None
+            self.count_array = None
+        return self
+
+    def freeze(self):
+        if self.key_array is None:
+            keys = sorted(self.counts)
+            self.key_array = int64_array(keys)
+            self.count_array = int64_array(self.counts[key] for key in keys)
+            self.counts = None
+        return self
+
+    def get(self, gram, default=None):
+        key = self.key_of(gram)
+        if key is None:
+            return default
+        if self.key_array is None:
+            return self.counts.get(key, default)
+        i = bisect.bisect_left(self.key_array, key)
+        if i < len(self.key_array) and self.key_array[i] == key:
+            return self.count_array[i]
+        return default
+
+    def __contains__(self, gram):
+        return self.get(gram) is not None
+
+    def __getitem__(self, gram):
+        count = self.get(gram)
+        if count is None:
+            raise KeyError(gram)
+        return count
+
+    def __len__(self):
+        return len(self.key_array) if self.key_array is not None else len(self.counts)
+
+    def iteritems(self):
+        """
+        Yields ("a_b_c", count) pairs, the layout of the JSON model files.
+        """
+        for key, count in self.packed_items():
+            yield "_".join(self.unpack(key)), count
+
+    def packed_items(self):
+        if self.key_array is None:
+            return self.counts.iteritems()
+        return itertools.izip(self.key_array, self.count_array)
+
+    def values(self):
+        return self.count_array if self.key_array is not None else self.counts.values()
+
+    def to_dict(self):
+        return dict(self.iteritems())
+
+class Binary_Model:
+    """
+    Versioned binary model file: one vocabulary and the counts of every
+    order, read through mmap with numpy views instead of building dicts.
+
+    Layout (little-endian, sections 8 byte aligned):
+        header        magic, version, max order, vocabulary size, token
+                      blob size, hash table size, then entries per order
+        offsets       int64[vocab + 1], start of each token in the blob
+        blob          UTF-8 tokens back to back
+        hash table    int64[hash size], token id or -1, open addressing
+                      on crc32(token)
+        per order     int64[entries] sorted packed keys (see NGram_Store),
+                      then int64[entries] counts
+    """
+    MAGIC = 'NGMB'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIIQQQ')
+    # Counts are streamed to a side file while the keys are written, in blocks of:
+    WRITE_BLOCK = 1 << 16
+    # Tokens whose id (or -1) ids_of() remembers; the memo starts over when full:
+    MEMO_SIZE = 1 << 20
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.max_order, vocab_size, blob_size, hash_size = self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC:
+            raise ValueError("%s is not a binary n-gram model" % path)
+        if version != self.VERSION:
+            raise ValueError("%s has model version %d, expected %d" % (path, version, self.VERSION))
+        pos = self.HEADER.size
+        entries = struct.unpack_from('<%dQ' % self.max_order, self.mm, pos)
+        pos = self.align(pos + 8 * self.max_order)
+        self.offsets = np.frombuffer(self.mm, dtype='<i8', count=vocab_size + 1, offset=pos)
+        pos += 8 * (vocab_size + 1)
+        self.blob_start = pos
+        pos = self.align(pos + blob_size)
+        self.hash_table = np.frombuffer(self.mm, dtype='<i8', count=hash_size, offset=pos)
+        self.hash_mask = hash_size - 1
+        pos += 8 * hash_size
+        self.vocab_size = vocab_size
+        self.memo = {}
+        self.keys = {}
+        self.counts = {}
+        for n, count in zip(range(1, self.max_order + 1), entries):
+            self.keys[n] = np.frombuffer(self.mm, dtype='<i8', count=count, offset=pos)
+            pos += 8 * count
+            self.counts[n] = np.frombuffer(self.mm, dtype='<i8', count=count, offset=pos)
+            pos += 8 * count
+
+    @classmethod
+    def align(self, pos):
+        return (pos + 7) & ~7
+
+    @classmethod
+    def encode(self, token):
+        return token.encode('utf-8') if isinstance(token, unicode) else token
+
+    def token(self, token_id):
+        start = self.blob_start + int(self.offsets[token_id])
+        end = self.blob_start + int(self.offsets[token_id + 1])
+        return self.mm[start:end].decode('utf-8')
+
+    def get(self, token):
+        """
+        Vocabulary lookup through the hash table: the token's id, or None.
+        """
+        if not self.vocab_size:
+            return None
+        raw = self.encode(token)
+        slot = zlib.crc32(raw) & self.hash_mask
+        while True:
+            token_id = int(self.hash_table[slot])
+            if token_id < 0:
+                return None
+            start = self.blob_start + int(self.offsets[token_id])
+            end = self.blob_start + int(self.offsets[token_id + 1])
+            if self.mm[start:end] == raw:
+                return token_id
+            slot = (slot + 1) & self.hash_mask
+
+    def ids_of(self, tokens):
+        """
+        Ids of a list of tokens, -1 for unknown ones. Each token goes
+        through the hash table once; after that it is a dict lookup, as
+        in Vocabulary.ids_of().
+        """
+        memo = self.memo
+        get = memo.get
+        ids = [get(token) for token in tokens]
+        if None in ids:
+            for i, token in enumerate(tokens):
+                if ids[i] is None:
+                    token_id = self.get(token)
+                    ids[i] = -1 if token_id is None else token_id
+                    if len(memo) >= self.MEMO_SIZE:
+                        memo.clear()
+                    memo[token] = ids[i]
+        return ids
+
+    def store(self, n):
+        return Mapped_NGram_Store(self, n)
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
+
+    @classmethod
+    def write(self, path, tokens, orders):
+        """
+        Arguments: tokens -- the vocabulary, in id order
+                   orders -- for n = 1, 2, ..., an iterable of (packed key, count) sorted by key
+        Writes to a temp file next to path and renames it over path when done.
+        """
+        raw_tokens = [self.encode(token) for token in tokens]
+        hash_size = 1
+        while hash_size < 2 * len(raw_tokens):
+            hash_size <<= 1
+        hash_table = int64_array([-1]) * hash_size
+        for token_id, raw in enumerate(raw_tokens):
+            slot = zlib.crc32(raw) & (hash_size - 1)
+            while hash_table[slot] >= 0:
+                slot = (slot + 1) & (hash_size - 1)
+            hash_table[slot] = token_id
+        offsets = int64_array([0])
+        for raw in raw_tokens:
+            offsets.append(offsets[-1] + len(raw))
+        blob_size = offsets[-1]
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            header_size = self.align(self.HEADER.size + 8 * len(orders))
+            f.write('\0' * header_size)
+            offsets.tofile(f)
+            for raw in raw_tokens:
+                f.write(raw)
+            f.write('\0' * (self.align(blob_size) - blob_size))
+            hash_table.tofile(f)
+            entries = []
+            for items in orders:
+                with tempfile.TemporaryFile() as count_file:
+                    written = 0
+                    keys, counts = int64_array(), int64_array()
+                    for key, count in items:
+                        keys.append(key)
+                        counts.append(count)
+                        if len(keys) >= self.WRITE_BLOCK:
+                            written += len(keys)
+                            keys.tofile(f)
+                            counts.tofile(count_file)
+                            keys, counts = int64_array(), int64_array()
+                    written += len(keys)
+                    keys.tofile(f)
+                    counts.tofile(count_file)
+                    count_file.seek(0)
+                    shutil.copyfileobj(count_file, f)
+                entries.append(written)
+            f.seek(0)
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, len(orders), len(raw_tokens), blob_size, hash_size))
+            f.write(struct.pack('<%dQ' % len(orders), *entries))
+        os.rename(tmp_path, path)
+
+class Mapped_NGram_Store(NGram_Store):
+    """
+    Read-only NGram_Store over one order of a Binary_Model, so the scoring
+    code can use it in place of a store or a JSON dict.
+    """
+    def __init__(self, model, n):
+        self.n = n
+        self.vocab = model
+        self.counts = None
+        self.key_array = model.keys[n]
+        self.count_array = model.counts[n]
+
+    def get(self, gram, default=None):
+        key = self.key_of(gram)
+        if key is None:
+            return default
+        i = int(np.searchsorted(self.key_array, key))
+        if i < len(self.key_array) and self.key_array[i] == key:
+            return int(self.count_array[i])
+        return default
 
 class NGram_Helpers:   
     
-    hash_dict = {}
     forum_dict = {}
     forum_three_dict = {}
     forum_two_dict = {}
@@ -266,10 +1042,66 @@ class NGram_Helpers:
         
         
     def __init__(self,samples):
-        self.unigrams = self.loop(samples,1,1)
-        self.bigrams = self.loop(samples,2,1)
-        self.trigrams = self.loop(samples,3,1)
+        self.vocab = Vocabulary()
+        self.unigrams = NGram_Store(1, self.vocab)
+        self.bigrams = NGram_Store(2, self.vocab)
+        self.trigrams = NGram_Store(3, self.vocab)
+        self.count_samples(samples)
+        self.freeze()
+
+    def freeze(self):
+        with profiler.stage('freeze'):
+            for n_store in (self.unigrams, self.bigrams, self.trigrams):
+                n_store.freeze()
         self.total_words = sum(self.unigrams.values())
+
+    def merge(self, other):
+        """
+        Adds the counts of another NGram_Helpers, e.g. a shard trained by
+        train_parallel(); call freeze() once all shards are merged.
+        """
+        id_map = [self.vocab.add(token) for token in other.vocab.tokens]
+        self.unigrams.merge(other.unigrams, id_map)
+        self.bigrams.merge(other.bigrams, id_map)
+        self.trigrams.merge(other.trigrams, id_map)
+        return self
+
+    @classmethod
+    def train_parallel(self, jobs, workers):
+        """
+        Arguments: jobs -- (root_dir, file_name) pairs, workers -- processes to use
+        Value: an NGram_Helpers with the same counts as training on all files in one process
+        Each worker trains on whole files and sends back its shard; the
+        biggest files go first so the pool stays busy until the end.
+        """
+        jobs = sorted(jobs, key=lambda job: -os.path.getsize(os.path.join(os.path.expanduser(job[0]), job[1])))
+        n = self([])
+        pool = multiprocessing.Pool(workers)
+        try:
+            for shard in merge_profiled(pool.imap_unordered(run_profiled, [(train_shard, job) for job in jobs])):
+                with profiler.stage('merge', 1):
+                    n.merge(shard)
+        finally:
+            pool.close()
+            pool.join()
+        n.freeze()
+        return n
+
+    def count_samples(self, samples):
+        """
+        Tokenizes each sample once and counts all three orders from it.
+        The trigram padding "* * w1 .. wn ~STOP~" holds the bigram padding
+        (drop one "*") and the unigram sequence (drop both), so this gives
+        the same counts as loop() with num = 1, 2 and 3.
+        """
+        add = self.vocab.add
+        with profiler.stage('count') as stage:
+            for words in profiler.iterate('tokenize', tok.tokenize_many(samples)):
+                ids = map(add, self.pad_tokens(words, 3))
+                self.trigrams.count_ids(ids)
+                self.bigrams.count_ids(ids[1:])
+                self.unigrams.count_ids(ids[2:])
+                stage.add(1)
         
     """
     loop tokenizes tweets before building ngrams
@@ -277,13 +1109,15 @@ class NGram_Helpers:
     #refactor along with build_forum     
     def loop(self, samples, num, method_name):
         n_list = []
-        n_dict = {}    
-        for s in samples:
-            n_list = self.build_tweet(s, num, method_name)
-            n_list = self.build_ngrams(n_list, num)
-            self.hash_dict.update(self.count_gram(n_list, self.hash_dict))
-            n_dict.update(self.count_gram(n_list, n_dict))
-        return  n_dict
+        n_store = NGram_Store(num, self.vocab)
+        if method_name == METHOD_NAME.get('TOKENIZE'):
+            tokenized = (self.pad_tokens(words, num) for words in tok.tokenize_many(samples))
+        else:
+            tokenized = (self.build_tweet(s, num, method_name) for s in samples)
+        for n_list in tokenized:
+            for gram in self.build_ngram_tuples(n_list, num):
+                n_store.add(gram)
+        return n_store.freeze()
 
     def build_forum(self, samples, num, method_name):
         self.clear_dicts()
@@ -304,6 +1138,10 @@ class NGram_Helpers:
         for s in samples:
             parsed_sentence += self.build_tweet(s, num, 4)
             
+    @classmethod
+    def pad_tokens(self, words, num):
+        return ["*"] * (num - 1) + words + ["~STOP~"]
+
     @classmethod        
     def build_tweet(self, s, num, method_name):
         tokenized = []
@@ -333,6 +1171,10 @@ class NGram_Helpers:
             #print hash_list.count(hash_gram)
         return hash_list
     
+    @classmethod
+    def build_ngram_tuples(self, tokenized, num):
+        return zip(*[tokenized[i:] for i in range(num)])
+
     @classmethod    
     def count_gram(self, ngram_list, hash_gram):
         for gram in ngram_list:
@@ -348,10 +1190,11 @@ class NGram_Helpers:
         count_list = []
         special_case = []
         for i in string_input:
-           if str(i.encode('utf-8')).find("*") >= 0 and i in r_gram_dict:
-              special_case.append(r_gram_dict.get(i))
-           elif not str(i.encode('utf-8')).find('*') >= 0 and i in r_gram_dict:
-              count_list.append(r_gram_dict.get(i))
+           count = r_gram_dict.get(i)
+           if "*" in i and count is not None:
+              special_case.append(count)
+           elif count is not None:
+              count_list.append(count)
            else:
               count_list.append(0.0) 
         return special_case, count_list
@@ -392,8 +1235,808 @@ class NGram_Helpers:
             p_1gram = z/total_words
         return (l1 * p_3gram) + (l2 * p_2gram) + (l3 * p_1gram) + (l4 * 1/(2 * total_words))       
             
+class Clean_Rules:
+    """
+    Spam and boilerplate cleanup rules compiled into one regex, so a line
+    is scanned once however many rules there are. Literal rules are merged
+    into a trie-shaped alternation (shared prefixes are only tried once)
+    that comes first; the few "re:" rules follow it as named groups, so
+    they only match where no literal does. Python 2's re allows 100
+    groups per pattern, which caps the "re:" rules (and any groups
+    inside them) at MAX_REGEX_GROUPS.
+    """
+    MAX_REGEX_GROUPS = 99
+
+    def __init__(self, rules):
+        """
+        Argument: rules -- (pattern, replacement, is_regex) tuples in file order
+        """
+        self.literals = {}
+        self.regex_replacements = []
+        branches = []
+        for pattern, replacement, is_regex in rules:
+            if is_regex:
+                branches.append("(?P<r%d>%s)" % (len(self.regex_replacements), pattern))
+                self.regex_replacements.append(replacement)
+            else:
+                self.literals[pattern] = replacement
+        if self.literals:
+            branches.insert(0, self.trie_regex(self.literals))
+        if len(self.regex_replacements) > self.MAX_REGEX_GROUPS:
+            raise ValueError("%d regex rules, at most %d fit in one pattern" % (len(self.regex_replacements), self.MAX_REGEX_GROUPS))
+        try:
+            self.pattern = re.compile("|".join(branches) or "(?!)")
+        except AssertionError:
+            # sre_compile's "only supports 100 named groups":
+            raise ValueError("the regex rules use more than %d groups between them" % self.MAX_REGEX_GROUPS)
+
+    @classmethod
+    def read(self, path):
+        rules = []
+        with open(path) as f:
+            for line in f:
+                line = line.rstrip('\r\n')
+                if not line or line.startswith('#'):
+                    continue
+                pattern, sep, replacement = line.partition('\t')
+                if pattern.startswith('re:'):
+                    rules.append((pattern[3:], replacement, True))
+                else:
+                    rules.append((pattern, replacement, False))
+        return self(rules)
+
+    @classmethod
+    def trie_regex(self, words):
+        trie = {}
+        for word in words:
+            node = trie
+            for ch in word:
+                node = node.setdefault(ch, {})
+            node[''] = True
+        return self.trie_node_regex(trie)
+
+    @classmethod
+    def trie_node_regex(self, node):
+        branches = [re.escape(ch) + self.trie_node_regex(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ''
+        # A word may end here, so the longer continuations are optional (tried first, greedily):
+        if '' in node:
+            return "(?:%s)?" % "|".join(branches)
+        if len(branches) == 1:
+            return branches[0]
+        return "(?:%s)" % "|".join(branches)
+
+    def replace(self, m):
+        name = m.lastgroup
+        if name is not None and name.startswith('r'):
+            return self.regex_replacements[int(name[1:])]
+        return self.literals[m.group()]
+
+    def sub(self, s):
+        return self.pattern.sub(self.replace, s)
+
+class NGram_Spill_Counter:
+    """
+    Out-of-core version of NGram_Helpers training for corpora larger than
+    RAM. Counts go into NGram_Stores as usual; when they hold more entries
+    than the memory budget allows, each store is frozen and written to a
+    temp file as a sorted run. write_json() merges the runs of an order
+    with heapq and streams the summed counts straight into the model file.
+    Only the Vocabulary stays in memory for the whole run.
+
+    count_samples() tokenizes the texts once, into a file of token ids
+    (4 bytes a token), before it counts anything. A corpus with more
+    distinct tokens than Vocabulary.MAX_SIZE therefore fails during that
+    pass, not after hours of counting and spilling.
+    """
+    # Rough cost of one count in an NGram_Store dict (slot, int key, int count):
+    BYTES_PER_ENTRY = 100
+    # Entries read from a run file at a time while merging:
+    READ_BLOCK = 1 << 16
+
+    def __init__(self, memory_budget_mb, tmp_dir=None):
+        self.max_entries = max(1, int(memory_budget_mb * 1024 * 1024 // self.BYTES_PER_ENTRY))
+        self.tmp_dir = tempfile.mkdtemp(prefix='ngram_runs_', dir=tmp_dir)
+        self.vocab = Vocabulary()
+        self.runs = { 1:[], 2:[], 3:[] }
+        self.new_stores()
+
+    def new_stores(self):
+        self.stores = dict((n, NGram_Store(n, self.vocab)) for n in (1, 2, 3))
+
+    def count_samples(self, samples):
+        """
+        Counts every text of samples; pass all of the corpus in one call,
+        so the vocabulary is complete before counting starts.
+        """
+        path = self.write_ids(samples)
+        try:
+            self.count_ids(self.read_ids(path))
+        finally:
+            os.remove(path)
+
+    def write_ids(self, samples):
+        """
+        Value: a temp file of the padded token ids of every text, each
+        text ended by -1. Vocabulary.add() raises OverflowError here if
+        the corpus has too many distinct tokens.
+        """
+        add = self.vocab.add
+        path = os.path.join(self.tmp_dir, 'ids')
+        with profiler.stage('vocabulary') as stage, open(path, 'wb') as f:
+            block = array.array('i')
+            for words in profiler.iterate('tokenize', tok.tokenize_many(samples)):
+                block.extend(map(add, NGram_Helpers.pad_tokens(words, 3)))
+                block.append(-1)
+                stage.add(1)
+                if len(block) >= self.READ_BLOCK:
+                    block.tofile(f)
+                    block = array.array('i')
+            block.tofile(f)
+        return path
+
+    def read_ids(self, path):
+        """
+        Value: the id list of every text in a write_ids() file
+        """
+        with open(path, 'rb') as f:
+            rest = []
+            while True:
+                block = array.array('i')
+                try:
+                    block.fromfile(f, self.READ_BLOCK)
+                except EOFError:
+                    pass
+                if not block:
+                    break
+                ids = rest + block.tolist()
+                start = 0
+                while True:
+                    try:
+                        end = ids.index(-1, start)
+                    except ValueError:
+                        break
+                    yield ids[start:end]
+                    start = end + 1
+                rest = ids[start:]
+
+    def count_ids(self, texts):
+        unigrams, bigrams, trigrams = self.stores[1], self.stores[2], self.stores[3]
+        with profiler.stage('count') as stage:
+            for ids in texts:
+                trigrams.count_ids(ids)
+                bigrams.count_ids(ids[1:])
+                unigrams.count_ids(ids[2:])
+                stage.add(1)
+                if len(trigrams) + len(bigrams) + len(unigrams) > self.max_entries:
+                    with profiler.stage('spill'):
+                        self.spill()
+                    unigrams, bigrams, trigrams = self.stores[1], self.stores[2], self.stores[3]
+
+    def spill(self):
+        for n, n_store in self.stores.iteritems():
+            if len(n_store) == 0:
+                continue
+            n_store.freeze()
+            run = int64_array()
+            for key, count in n_store.packed_items():
+                run.append(key)
+                run.append(count)
+            path = os.path.join(self.tmp_dir, '%dgram_%04d.run' % (n, len(self.runs[n])))
+            with open(path, 'wb') as f:
+                run.tofile(f)
+            self.runs[n].append(path)
+        self.new_stores()
+
+    def read_run(self, path):
+        with open(path, 'rb') as f:
+            while True:
+                block = int64_array()
+                try:
+                    block.fromfile(f, 2 * self.READ_BLOCK)
+                except EOFError:
+                    pass
+                if not block:
+                    break
+                for i in xrange(0, len(block), 2):
+                    yield block[i], block[i + 1]
+
+    def merged_items(self, n):
+        """
+        Yields (packed key, count) for order n in key order, summing the
+        counts of every run and of what is still in memory.
+        """
+        sources = [self.read_run(path) for path in self.runs[n]]
+        sources.append(iter(sorted(self.stores[n].packed_items())))
+        current, total = None, 0
+        for key, count in heapq.merge(*sources):
+            if key != current:
+                if current is not None:
+                    yield current, total
+                current, total = key, 0
+            total += count
+        if current is not None:
+            yield current, total
+
+    def write_json(self, fi, n, file_name, root_dir='~/twitter/test_data/forumPost'):
+        unpack = self.stores[n].unpack
+        fi.write_json_items((("_".join(unpack(key)), count) for key, count in self.merged_items(n)), file_name, root_dir)
+
+    def write_binary(self, file_name="nGram.bin", root_dir='~/twitter/test_data/forumPost'):
+        path = os.path.join(os.path.expanduser(root_dir), file_name)
+        with profiler.stage('write binary'):
+            Binary_Model.write(path, self.vocab.tokens, [self.merged_items(1), self.merged_items(2), self.merged_items(3)])
+
+    def close(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+class NGram_Scorer:
+    """
+    Scores batches of texts against a trained model (three stores sharing a
+    vocabulary) with the same interpolation as tweet_pr(), but in log space
+    and with numpy: every n-gram of a batch is looked up with one
+    searchsorted per order, and the unigram total is summed once here
+    instead of once per tweet.
+
+    count_vectors() returns the per-position counts that pr_gram() would
+    give, already lined up the way probability() and start_probability()
+    zip them, so they can be rescored with other weights without
+    tokenizing again.
+    """
+    def __init__(self, trigrams, bigrams, unigrams, weights=(0.85, 0.1, 0.04, 0.01)):
+        self.vocab = unigrams.vocab
+        self.weights = weights
+        self.keys = {}
+        self.counts = {}
+        for n, n_store in ((1, unigrams), (2, bigrams), (3, trigrams)):
+            n_store.freeze()
+            self.keys[n] = self.as_int64(n_store.key_array)
+            self.counts[n] = self.as_int64(n_store.count_array).astype(np.float64)
+        self.total_words = self.counts[1].sum()
+        self.star_id = self.token_id("*")
+        self.stop_id = self.token_id("~STOP~")
+
+    @classmethod
+    def as_int64(self, values):
+        if isinstance(values, array.array):
+            return np.frombuffer(values, dtype=np.int64) if len(values) else np.zeros(0, dtype=np.int64)
+        return np.asarray(values, dtype=np.int64)
+
+    def token_id(self, token):
+        token_id = self.vocab.get(token)
+        return -1 if token_id is None else token_id
+
+    def lookup(self, n, ids):
+        """
+        Arguments: n -- order, ids -- n arrays of token ids (-1 for unknown tokens)
+        Value: the count of every n-gram, 0.0 when it was never seen, and whether it was seen
+        """
+        valid = np.ones(len(ids[0]), dtype=bool)
+        keys = np.zeros(len(ids[0]), dtype=np.int64)
+        for token_ids in ids:
+            valid &= token_ids >= 0
+            keys = (keys << Vocabulary.ID_BITS) | np.maximum(token_ids, 0)
+        key_array = self.keys[n]
+        if len(key_array) == 0:
+            return np.zeros(len(keys)), np.zeros(len(keys), dtype=bool)
+        i = np.minimum(np.searchsorted(key_array, keys), len(key_array) - 1)
+        found = valid & (key_array[i] == keys)
+        return np.where(found, self.counts[n][i], 0.0), found
+
+    def count_vectors(self, token_lists):
+        """
+        Argument: token_lists -- tokenized texts, as tokenize() returns them
+        Value: a dict of numpy arrays; x, y, z are the trigram, bigram and
+        unigram counts zipped by probability(), st_x, st_y the counts zipped
+        by start_probability(), and seg, st_seg the text each term belongs to
+        """
+        ids = []
+        positions = []
+        ids_of = self.vocab.ids_of
+        for words in token_lists:
+            ids.extend((self.star_id, self.star_id))
+            ids.extend(ids_of(words))
+            ids.append(self.stop_id)
+            # One trigram, bigram and unigram per token plus ~STOP~:
+            positions.append(len(words) + 1)
+        ids = np.array(ids, dtype=np.int64)
+        positions = np.array(positions, dtype=np.int64)
+        texts = len(positions)
+        # Start of each text in ids and in the flat per-position arrays:
+        id_start = np.cumsum(positions + 2) - (positions + 2)
+        pos_start = np.cumsum(positions) - positions
+        text_of_pos = np.repeat(np.arange(texts), positions)
+        flat = id_start[text_of_pos] + np.arange(len(text_of_pos)) - pos_start[text_of_pos]
+        id0, id1, id2 = ids[flat], ids[flat + 1], ids[flat + 2]
+        c3, f3 = self.lookup(3, (id0, id1, id2))
+        c2, f2 = self.lookup(2, (id0, id1))
+        c1, f1 = self.lookup(1, (id0,))
+
+        # The first two positions hold "*". pr_gram() puts those n-grams in a
+        # separate list when found and a 0.0 at the head of the counts when
+        # not, so each order's counts are shifted by its number of misses.
+        has_second = positions >= 2
+        second = np.minimum(pos_start + 1, len(text_of_pos) - 1)
+        misses = []
+        for found in (f3, f2, f1):
+            misses.append((~found[pos_start]).astype(np.int64) + (has_second & ~found[second]))
+        tail = np.maximum(positions - 2, 0)
+        terms = tail + np.minimum(np.minimum(misses[0], misses[1]), misses[2])
+        seg = np.repeat(np.arange(texts), terms)
+        k = np.arange(len(seg)) - (np.cumsum(terms) - terms)[seg]
+        aligned = []
+        for counts, miss in zip((c3, c2, c1), misses):
+            shifted = k - miss[seg]
+            index = np.clip(pos_start[seg] + 2 + shifted, 0, max(len(counts) - 1, 0))
+            aligned.append(np.where(shifted >= 0, counts[index] if len(counts) else 0.0, 0.0))
+
+        # start_probability() zips the found "*" trigrams with the found "*" bigrams:
+        found3 = (f3[pos_start].astype(np.int64), (has_second & f3[second]).astype(np.int64))
+        found2 = (f2[pos_start].astype(np.int64), (has_second & f2[second]).astype(np.int64))
+        first3 = np.where(found3[0] > 0, c3[pos_start], c3[second])
+        first2 = np.where(found2[0] > 0, c2[pos_start], c2[second])
+        pairs = np.minimum(found3[0] + found3[1], found2[0] + found2[1])
+        one, two = pairs >= 1, pairs >= 2
+        st_seg = np.concatenate((np.arange(texts)[one], np.arange(texts)[two]))
+        st_x = np.concatenate((first3[one], c3[second][two]))
+        st_y = np.concatenate((first2[one], c2[second][two]))
+        return { 'texts':texts, 'seg':seg, 'x':aligned[0], 'y':aligned[1], 'z':aligned[2],
+                 'st_seg':st_seg, 'st_x':st_x, 'st_y':st_y }
+
+    def log_scores_from_counts(self, vectors, weights=None):
+        """
+        Natural log of tweet_pr() for every text of count_vectors().
+        """
+        l1, l2, l3, l4 = weights or self.weights
+        smooth = l4 * 1/(2 * self.total_words)
+        x, y, z = vectors['x'], vectors['y'], vectors['z']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p3 = np.where(y != 0, x / y, 0.0)
+            p2 = np.where(z != 0, y / z, 0.0)
+        p1 = z / self.total_words
+        ratio = l1 * p3 + l2 * p2 + l3 * p1 + smooth
+        texts = vectors['texts']
+        # bincount() of an empty array is integer even with weights:
+        log_pr = np.bincount(vectors['seg'], weights=np.log(ratio), minlength=texts).astype(np.float64)
+        log_pr[np.bincount(vectors['seg'], minlength=texts) == 0] = np.log(smooth)
+        st_ratio = l1 * vectors['st_x'] / vectors['st_y'] + smooth
+        log_st = np.bincount(vectors['st_seg'], weights=np.log(st_ratio), minlength=texts).astype(np.float64)
+        log_st[np.bincount(vectors['st_seg'], minlength=texts) == 0] = np.log(smooth)
+        return log_st + log_pr
+
+    def weight_components(self, vectors):
+        """
+        One row per factor of the scores in vectors, one column per weight:
+        every factor is row . (l1, l2, l3, l4), so weights can be refitted
+        from these rows alone. Texts without factors get the (0, 0, 0, u)
+        row that stands for the l4 * u fallback.
+        """
+        smooth = 1/(2 * self.total_words)
+        x, y, z = vectors['x'], vectors['y'], vectors['z']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p3 = np.where(y != 0, x / y, 0.0)
+            p2 = np.where(z != 0, y / z, 0.0)
+        p1 = z / self.total_words
+        texts = vectors['texts']
+        empty = (np.bincount(vectors['seg'], minlength=texts) == 0).sum() + (np.bincount(vectors['st_seg'], minlength=texts) == 0).sum()
+        start = len(vectors['st_x'])
+        zeros = np.zeros(start + empty)
+        return np.vstack((np.column_stack((p3, p2, p1, np.full(len(x), smooth))),
+                          np.column_stack((np.concatenate((vectors['st_x'] / vectors['st_y'], np.zeros(empty))),
+                                           zeros, zeros, np.full(start + empty, smooth)))))
+
+    def tune_weights(self, vectors, method='em', iterations=500, tol=1e-10, step=0.05):
+        """
+        Fits (l1, l2, l3, l4) to maximize the summed log score of the texts
+        in vectors (from count_vectors() on held-out data), without
+        tokenizing or looking anything up again.
+        method -- 'em': EM for mixture weights, starting from self.weights
+                  'grid': every weight vector on the simplex in steps of step, l4 > 0
+        Value: (weights, log likelihood)
+        """
+        components = self.weight_components(vectors)
+        if method == 'em':
+            weights = np.array(self.weights, dtype=np.float64)
+            weights /= weights.sum()
+            last = None
+            for i in range(iterations):
+                mix = components * weights
+                total = mix.sum(axis=1)
+                likelihood = np.log(total).sum()
+                if last is not None and likelihood - last <= tol * abs(likelihood):
+                    break
+                last = likelihood
+                weights = (mix / total[:, None]).mean(axis=0)
+            return tuple(weights), likelihood
+        elif method == 'grid':
+            steps = int(round(1 / step))
+            grid = np.array([(a, b, c, steps - a - b - c) for a in range(steps + 1) for b in range(steps + 1 - a)
+                             for c in range(steps + 1 - a - b) if a + b + c < steps], dtype=np.float64) / steps
+            best, best_likelihood = None, None
+            for i in range(0, len(grid), 64):
+                likelihoods = np.log(components.dot(grid[i:i + 64].T)).sum(axis=0)
+                j = int(np.argmax(likelihoods))
+                if best is None or likelihoods[j] > best_likelihood:
+                    best, best_likelihood = grid[i + j], likelihoods[j]
+            return tuple(best), best_likelihood
+        raise ValueError("unknown tuning method %r" % method)
+
+    def log_scores(self, texts, weights=None, tokenizer=None):
+        """
+        tokenizer defaults to the global tok; the scorer itself is read only,
+        so threads can share it as long as each has its own tokenizer.
+        """
+        tokenizer = tokenizer or tok
+        return self.log_scores_from_counts(self.count_vectors(list(tokenizer.tokenize_many(texts))), weights)
+
+    def scores(self, texts, weights=None, tokenizer=None):
+        """
+        Probabilities like tweet_pr(); long texts can underflow to 0.0 here,
+        log_scores() does not.
+        """
+        return np.exp(self.log_scores(texts, weights, tokenizer))
+
+def clean_chunk(job):
+    """
+    Pool worker for File_Utils.gather: cleans one chunk of a file.
+    """
+    tweet_file, lines, last = job
+    fi = File_Utils()
+    with profiler.stage('clean', len(lines)):
+        return tweet_file, [fi.clean_posts(s).lower() for s in lines], last
+
+def filter_tsv_file(job):
+    """
+    Pool worker for File_Utils.parse_tsv_tweets: filters and scores one file.
+    """
+    return File_Utils().filter_tsv(*job)
+
+def train_shard(job):
+    """
+    Pool worker for NGram_Helpers.train_parallel: trains on one file.
+    """
+    root_dir, file_name = job
+    return NGram_Helpers(File_Utils().iter_fragments([file_name], root_dir))
+
+class Geo_Index:
+    """
+    US location matcher for tweet location fields. Comma-separated pieces
+    are first looked up in a set of the Geo names, as split_tweets_tsv()
+    always did. Otherwise full names are found anywhere in the field by
+    walking its words through a trie, whatever their case, so multi-word
+    places like "Los Angeles" match in free text. Two letter state codes
+    are too often plain words ("OK", "IN", "HI") for that: outside a comma
+    piece of their own they only count as the last word, before an
+    optional ZIP, of a field that is not all capitals ("Austin TX").
+    With a bbox, "lat,lon" pairs (e.g. "iPhone: 40.71,-74.00") are also
+    tested against it, for a whole batch at a time.
+    """
+    # lon_min, lat_min, lon_max, lat_max as the streaming API takes it:
+    US_BBOX = (-125.3, 25.1, -66.9, 48.6)
+    # Places that are also somewhere else, and words that mean the other one:
+    NOT_US = { 'Georgia': frozenset(['tbilisi', 'batumi', 'kutaisi', 'rustavi', 'zugdidi', 'sakartvelo']) }
+    word_re = re.compile(r"[A-Za-z]+")
+    code_re = re.compile(r"^[A-Z]{2}$")
+    code_tail_re = re.compile(r"\b([A-Z]{2})(?:\s+\d{5}(?:-\d{4})?)?\s*$")
+    coord_re = re.compile(r"(-?\d{1,2}\.\d+)\s*,\s*(-?\d{1,3}\.\d+)")
+
+    def __init__(self, places=Geo, bbox=None):
+        self.names = frozenset(places)
+        self.codes = frozenset(place for place in places if self.code_re.match(place))
+        self.bbox = bbox
+        self.trie = {}
+        for place in places:
+            if place in self.codes:
+                continue
+            node = self.trie
+            for word in self.word_re.findall(place):
+                node = node.setdefault(word.lower(), {})
+            node[''] = place
+
+    def is_us(self, place, location):
+        other = self.NOT_US.get(place)
+        return other is None or other.isdisjoint(self.word_re.findall(location.lower()))
+
+    def find_place(self, location):
+        """
+        Value: the first Geo name in location, or None
+        """
+        for piece in location.split(', '):
+            if piece in self.names and self.is_us(piece, location):
+                return piece
+        m = self.code_tail_re.search(location)
+        if m and m.group(1) in self.codes and (',' in location or not location.isupper()):
+            return m.group(1)
+        words = self.word_re.findall(location.lower())
+        trie = self.trie
+        for i, word in enumerate(words):
+            node = trie.get(word)
+            j = i + 1
+            while node is not None:
+                if '' in node and self.is_us(node[''], location):
+                    return node['']
+                if j == len(words):
+                    break
+                node = node.get(words[j])
+                j += 1
+        return None
+
+    def coordinates(self, location):
+        m = self.coord_re.search(location)
+        if m:
+            return float(m.group(1)), float(m.group(2))
+        return None
+
+    def in_bbox(self, lats, lons):
+        """
+        Arguments: lats, lons -- numpy arrays (or lists) of degrees
+        Value: boolean array, True inside self.bbox
+        """
+        lon_min, lat_min, lon_max, lat_max = self.bbox
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        return (lats >= lat_min) & (lats <= lat_max) & (lons >= lon_min) & (lons <= lon_max)
+
+    def match(self, location):
+        return self.match_many([location])[0]
+
+    def match_many(self, locations):
+        """
+        Value: a list with True for every location in the US
+        """
+        found = [self.find_place(location) is not None for location in locations]
+        if self.bbox is not None:
+            rest = []
+            coords = []
+            for i, location in enumerate(locations):
+                if not found[i]:
+                    coord = self.coordinates(location)
+                    if coord is not None:
+                        rest.append(i)
+                        coords.append(coord)
+            if coords:
+                lats, lons = zip(*coords)
+                for i, inside in zip(rest, self.in_bbox(lats, lons)):
+                    found[i] = bool(inside)
+        return found
+
+class Bloom_Filter:
+    """
+    Fixed-size set of fingerprints that may answer "seen" for a line it has
+    not seen, with probability error_rate once capacity lines are in.
+    """
+    def __init__(self, capacity=10000000, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def add(self, digest):
+        """
+        Argument: digest -- a 16 byte md5 digest of the key
+        Value: True if the key was (probably) added before
+        """
+        h1, h2 = struct.unpack('<QQ', digest)
+        seen = True
+        for i in range(self.num_hashes):
+            bit = (h1 + i * h2) % self.num_bits
+            byte, mask = bit >> 3, 1 << (bit & 7)
+            if not self.bits[byte] & mask:
+                self.bits[byte] |= mask
+                seen = False
+        return seen
+
+    def memory(self):
+        return len(self.bits)
+
+class Dup_Filter:
+    """
+    Remembers the lines File_Utils.gather() has kept, without keeping the
+    lines themselves.
+    mode -- 'exact': a set of 64 bit md5 fingerprints
+            'bloom': a Bloom_Filter, fixed memory for capacity lines
+            'minhash': MinHash signatures banded for LSH, so lines sharing
+                       about threshold of their word shingles count as
+                       duplicates too (reposted spam with a changed link)
+    """
+    MODES = ('exact', 'bloom', 'minhash')
+    NUM_PERM = 64
+    SHINGLE = 3
+    # Mersenne-like prime above 2**32 for the a*h+b permutations:
+    PRIME = 4294967311
+
+    def __init__(self, mode='exact', capacity=10000000, error_rate=0.001, threshold=0.8, seed=1):
+        if mode not in self.MODES:
+            raise ValueError("unknown dedup mode %r" % mode)
+        self.mode = mode
+        self.lines = 0
+        self.duplicates = 0
+        self.fingerprints = set()
+        if mode == 'bloom':
+            self.bloom = Bloom_Filter(capacity, error_rate)
+        elif mode == 'minhash':
+            rng = np.random.RandomState(seed)
+            self.perm_a = rng.randint(1, 1 << 32, self.NUM_PERM).astype(np.uint64)
+            self.perm_b = rng.randint(0, 1 << 32, self.NUM_PERM).astype(np.uint64)
+            self.rows = self.band_rows(self.NUM_PERM, threshold)
+            self.bands = [set() for i in range(self.NUM_PERM // self.rows)]
+
+    @classmethod
+    def band_rows(self, num_perm, threshold):
+        """
+        Rows per LSH band whose S-curve midpoint (1/b)**(1/r) is nearest threshold.
+        """
+        rows = [r for r in range(1, num_perm + 1) if num_perm % r == 0]
+        return min(rows, key=lambda r: abs((r / num_perm) ** (1 / r) - threshold))
+
+    def fingerprint(self, line):
+        return struct.unpack('<q', hashlib.md5(line).digest()[:8])[0]
+
+    def signature(self, words):
+        shingles = set(" ".join(words[i:i + self.SHINGLE]) for i in range(len(words) - self.SHINGLE + 1))
+        hashes = np.array([zlib.crc32(shingle) & 0xffffffff for shingle in shingles], dtype=np.uint64)
+        return ((np.outer(self.perm_a, hashes) + self.perm_b[:, None]) % self.PRIME).min(axis=1)
+
+    def seen(self, line):
+        """
+        Value: True if line (or, for 'minhash', a near copy of it) was seen
+        before; it is remembered either way.
+        """
+        self.lines += 1
+        if self.mode == 'bloom':
+            dup = self.bloom.add(hashlib.md5(line).digest())
+        elif self.mode == 'minhash' and len(line.split()) >= self.SHINGLE:
+            signature = self.signature(line.lower().split())
+            dup = False
+            for i, band in enumerate(self.bands):
+                key = hash(signature[i * self.rows:(i + 1) * self.rows].tostring())
+                if key in band:
+                    dup = True
+                else:
+                    band.add(key)
+        else:
+            key = self.fingerprint(line)
+            dup = key in self.fingerprints
+            self.fingerprints.add(key)
+        self.duplicates += dup
+        return dup
+
+    def memory(self):
+        """
+        Approximate bytes held by the store.
+        """
+        size = sys.getsizeof(self.fingerprints) + len(self.fingerprints) * sys.getsizeof(1 << 62)
+        if self.mode == 'bloom':
+            size += self.bloom.memory()
+        elif self.mode == 'minhash':
+            size += sum(sys.getsizeof(band) + len(band) * sys.getsizeof(1 << 62) for band in self.bands)
+        return size
+
+    def report(self):
+        rate = self.duplicates / self.lines if self.lines else 0.0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return ("dedup (%s): %d lines, %d duplicates (%.2f%%), store %.1f MB, peak RSS %.1f MB"
+                % (self.mode, self.lines, self.duplicates, 100 * rate, self.memory() / 2 ** 20, peak))
+
+class BZ2_Lines:
+    """
+    The lines of a .bz2 file. Python 2's BZ2File stops after the first
+    stream, silently dropping the rest of a pbzip2 or lbzip2 file, which
+    is several streams back to back; here each stream's unused_data
+    starts the next one. A file cut off inside a stream raises IOError.
+    """
+    BLOCK = 1 << 20
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    def chunks(self):
+        decompressor = bz2.BZ2Decompressor()
+        for data in iter(lambda: self.f.read(self.BLOCK), ''):
+            while data:
+                try:
+                    chunk = decompressor.decompress(data)
+                except EOFError:
+                    # The stream ended right at the end of the last block:
+                    decompressor = bz2.BZ2Decompressor()
+                    continue
+                data = decompressor.unused_data
+                if data:
+                    decompressor = bz2.BZ2Decompressor()
+                yield chunk
+        try:
+            decompressor.decompress('')
+        except EOFError:
+            return
+        raise IOError("%s: compressed file ended before the end of a stream" % self.path)
+
+    def __iter__(self):
+        pending = ''
+        for chunk in self.chunks():
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if pending:
+            yield pending
+
+class Corpus:
+    """
+    The sentence fragments of a group of files, read lazily: iterating
+    gives the same fragments as remove_punct(create_samples(...)) while
+    holding one line at a time; what callers keep is up to them
+    (File_Utils.score_corpus() remembers a fingerprint per fragment).
+    With use_mmap the files are mapped and read with readline(), which
+    avoids the file buffer copies on large dumps. A Corpus can be iterated any number of times.
+    """
+    def __init__(self, file_group, root_dir="~/Tweets", use_mmap=False):
+        self.tweet_path = os.path.expanduser(root_dir)
+        self.file_group = list(file_group)
+        self.use_mmap = use_mmap
+
+    @classmethod
+    def split_fragments(self, line):
+        if line == '\n':
+            return []
+        if sentence_end_re.search(line):
+            return re.split(sentence_end_re, line)
+        return [line]
+
+    def lines(self):
+        for tweet_file in self.file_group:
+            path = os.path.join(self.tweet_path, tweet_file)
+            with open(path, 'rb' if self.use_mmap else 'r') as f:
+                if not self.use_mmap:
+                    for line in f:
+                        yield line
+                elif os.path.getsize(path):
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        for line in iter(m.readline, ''):
+                            yield line
+                    finally:
+                        m.close()
+
+    def __iter__(self):
+        for line in profiler.iterate('read', self.lines()):
+            for fragment in self.split_fragments(line):
+                yield fragment
+
+    def batches(self, size):
+        """
+        Value: lists of up to size fragments
+        """
+        fragments = iter(self)
+        while True:
+            batch = list(itertools.islice(fragments, size))
+            if not batch:
+                return
+            yield batch
+
 class File_Utils:
-    dup_check_dict = {}
+    # Lines kept by gather() so far, across every directory of the run:
+    dup_filter = None
+    clean_rules = None
+    # NGram_Scorer used by tweet_pr(), set once the model is loaded:
+    scorer = None
+    log_prob = False
+    # Tweets scored per NGram_Scorer call while filtering TSV files:
+    score_batch = 1000
+    geo_index = Geo_Index()
+    # Corpus files are read through mmap:
+    use_mmap = False
     
     def crawl_directory(self, root_dir="~/Tweets"):
         file_group = []
@@ -408,117 +2051,275 @@ class File_Utils:
             samples.extend(open(os.path.join(tweet_path, tweet_file)))
         return samples
         
-    def gather(self, samples, root_dir="~/Tweets"):
+    def gather(self, samples, root_dir="~/Tweets", workers=1, chunk_size=1000):
+        """
+        Cleans every file in place, dropping lines dup_filter has seen. Files
+        are streamed: this process reads them and does the dedup, in file
+        order, and hands the kept lines in chunks of chunk_size to workers
+        processes for cleaning. Each file is written to a temp file that is
+        renamed over it once it is complete.
+        """
         tweet_path = os.path.expanduser(root_dir)
+        if self.dup_filter is None:
+            File_Utils.dup_filter = Dup_Filter()
+        if workers > 1:
+            # Bounds the chunks read ahead of the writer; stop ends the
+            # reading once the writer gives up:
+            slots = threading.Semaphore(4 * workers)
+            stop = threading.Event()
+            pool = multiprocessing.Pool(workers)
+            results = merge_profiled(pool.imap(run_profiled, ((clean_chunk, chunk) for chunk in
+                                                              self.dedup_chunks(samples, tweet_path, chunk_size,
+                                                                                slots, stop))))
+        else:
+            slots = stop = pool = None
+            results = itertools.imap(clean_chunk, self.dedup_chunks(samples, tweet_path, chunk_size))
+        tmp_file = out = None
+        try:
+            for tweet_file, lines, last in results:
+                if slots is not None:
+                    slots.release()
+                if out is None:
+                    tmp_file = os.path.join(tweet_path, '.%s.%d.tmp' % (tweet_file, os.getpid()))
+                    out = open(tmp_file, 'w')
+                out.writelines(lines)
+                if last:
+                    out.close()
+                    os.rename(tmp_file, os.path.join(tweet_path, tweet_file))
+                    tmp_file = out = None
+        finally:
+            if out is not None:
+                out.close()
+                os.remove(tmp_file)
+            if pool is not None:
+                # The pool's task thread may be waiting on a slot in
+                # dedup_chunks, and terminate() would wait for it:
+                stop.set()
+                slots.release()
+                pool.terminate()
+                pool.join()
+
+    # The temp files gather() writes:
+    gather_tmp_re = re.compile(r'\..+\.\d+\.tmp$')
+
+    def dedup_chunks(self, samples, tweet_path, chunk_size, slots=None, stop=None):
+        """
+        Value: (file name, new lines, last chunk of the file) for every
+        chunk_size lines not seen before, and at least one per file. With
+        slots, each chunk first takes one, and nothing more is read once
+        stop is set.
+        """
         for tweet_file in samples:
-            samples = []
-            t = ""
-            samples.extend(open(os.path.join(tweet_path, tweet_file)))
-            for s in samples:
-                self.dup_check_dict[s] = self.dup_check_dict.get(s, 0) + 1
-                if self.dup_check_dict.get(s) == 1:
-                    t += self.clean_posts(s).lower()
-            with open(os.path.join(tweet_path, tweet_file), 'w') as outfile:
-                outfile.write(t)
-                
+            if self.gather_tmp_re.match(tweet_file):
+                continue
+            chunk = []
+            with open(os.path.join(tweet_path, tweet_file)) as f:
+                for s in profiler.iterate('read', f):
+                    if not self.dup_filter.seen(s):
+                        chunk.append(s)
+                        if len(chunk) >= chunk_size:
+                            if slots is not None:
+                                slots.acquire()
+                                if stop.is_set():
+                                    return
+                            yield tweet_file, chunk, False
+                            chunk = []
+            if slots is not None:
+                slots.acquire()
+                if stop.is_set():
+                    return
+            yield tweet_file, chunk, True
+
     def clean_posts(self, word):       
-        word = re.sub(r'_________________________', "", word)
-        word = re.sub(r'99 for 2 day shipping if you dont', "", word)
-        word = re.sub(r'Happy Birthday To You', "", word)
-        word = re.sub(r'Julie BaumlerComputer Careers EditorComputer Careers ForumJulie', "", word)
-        word = re.sub(r'49 (free ship because I have Amazon Prime), but + 2', "", word)
-        word = re.sub(r'\(adsbygoogle = window', "", word)
-        word = re.sub(r'Myspace GraphicsQuizzesGlitter Graphics', "", word)
-        word = re.sub(r'&quot;', "", word)
-        word = re.sub(r'�', " ", word)
-        word = re.sub(r'•', " ", word)
-        word = re.sub(r'', " ", word)
-        word = re.sub(r'\(adsbygoogle = window.adsbygoogle \|\| \[\]\).push\(\{\}\);', "", word)
-        word = re.sub(r'Kimberly C. Cannon, Bulb Gardening EditorWele! Bulb Gardening website Bulb Gardening forum', "", word)
-        word = re.sub('http://www.wishafriend./acMyspace Graphics- Myspace Halloween Graphics', "", word)
-        word = re.sub('Myspace Comments- Myspace Layouts-Myspace Graphics', "", word)
-        word = re.sub(punct_string_re, "", word)
+        if self.clean_rules is None:
+            self.read_clean_rules()
+        word = self.clean_rules.sub(word)
         if word.startswith("."):
             word = word[1:]
         return word
+
+    @classmethod
+    def read_clean_rules(self, file_name='clean_rules.txt', root_dir=script_dir):
+        File_Utils.clean_rules = Clean_Rules.read(os.path.join(os.path.expanduser(root_dir), file_name))
         
-    def parse_tsv_tweets(self, file_array, root_dir="~/Tweets", out_path='~/GeoTweets', method_name=2):
-        i = 0
-        temp_filename = "temp.csv"
+    def parse_tsv_tweets(self, file_array, root_dir="~/Tweets", out_path='~/GeoTweets', method_name=2, workers=1):
+        """
+        SPLIT: keeps the US tweets of each TSV dump and appends their probability.
+        REPLACE: rescores the CSV files SPLIT wrote.
+        Dumps may still be .bz2 compressed; they are read as a stream. With
+        workers > 1 the files are spread over a process pool.
+        Value: (file name, rows read, rows written) for every file
+        """
+        jobs = [(root_dir, file_name, out_path, method_name) for file_name in file_array if not file_name.endswith('.tmp')]
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            try:
+                return list(merge_profiled(pool.imap_unordered(run_profiled, [(filter_tsv_file, job) for job in jobs])))
+            finally:
+                pool.close()
+                pool.join()
+        return [filter_tsv_file(job) for job in jobs]
+
+    def open_tweet_file(self, path):
+        if path.endswith('.bz2'):
+            return BZ2_Lines(path)
+        return open(path, 'rb')
+
+    def filter_tsv(self, root_dir, file_name, out_path, method_name):
+        """
+        One file of parse_tsv_tweets(). The output goes to a temp file that
+        is renamed into place at the end, so a crash never leaves half a
+        file and REPLACE can safely write over its own input.
+        """
         tweet_path = os.path.expanduser(root_dir)
         out_path = os.path.expanduser(out_path)
-        for file_name in file_array:
-            os.rename(os.path.join(tweet_path, file_name), os.path.join(tweet_path, temp_filename))
-            if method_name == METHOD_NAME.get('SPLIT'):
-                with open(os.path.join(tweet_path, temp_filename),'rb') as tsvin, open(os.path.join(out_path, file_name), 'wb') as csvout:
-                    tsvin = csv.reader((line.replace('\0','') for line in tsvin), delimiter='\t')
-                    csvout = csv.writer(csvout, delimiter=',')
-                    for row in tsvin:
-                        k = self.split_tweets_tsv(row)
-                        if len(k)== 5:
-                            k.append(self.tweet_pr(k[4]))
-                            csvout.writerows([k])
-                                
-            elif method_name == METHOD_NAME.get('REPLACE'):
-                with open(os.path.join(tweet_path, temp_filename),'rb') as tsvin, open(os.path.join(out_path, file_name), 'wb') as csvout:
-                    tsvin = csv.reader((line.replace('\0','') for line in tsvin), delimiter='\t')
-                    csvout = csv.writer(csvout, delimiter=',')
-                    for row in tsvin:
-                        row[5] = self.tweet_pr(row[4])
-                        file_name = str(row[5]) + " " + str(i) + ".csv"
-                        csvout.writerows([row])
+        out_name = file_name[:-len('.bz2')] if file_name.endswith('.bz2') else file_name
+        out_file = os.path.join(out_path, out_name)
+        tmp_file = os.path.join(out_path, '.%s.%d.tmp' % (out_name, os.getpid()))
+        delimiter = ',' if method_name == METHOD_NAME.get('REPLACE') else '\t'
+        rows_in = rows_out = 0
+        try:
+            with self.open_tweet_file(os.path.join(tweet_path, file_name)) as tsvin, open(tmp_file, 'wb') as csvout:
+                tsvin = csv.reader((line.replace('\0','') for line in tsvin), delimiter=delimiter)
+                csvout = csv.writer(csvout, delimiter=',')
+                batch = []
+                for row in profiler.iterate('read', tsvin):
+                    rows_in += 1
+                    if method_name == METHOD_NAME.get('SPLIT'):
+                        # Geo-filtered a batch at a time in write_scored():
+                        if len(row) != 5:
+                            continue
+                    elif method_name == METHOD_NAME.get('REPLACE'):
+                        if len(row) < 6:
+                            continue
+                        del row[5:]
+                    batch.append(row)
+                    if len(batch) >= self.score_batch:
+                        rows_out += self.write_scored(csvout, batch, method_name)
+                        batch = []
+                rows_out += self.write_scored(csvout, batch, method_name)
+            os.rename(tmp_file, out_file)
+        finally:
+            # Only left when the file failed part way:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        return file_name, rows_in, rows_out
+
+    def write_scored(self, csvout, rows, method_name):
+        if method_name == METHOD_NAME.get('SPLIT'):
+            with profiler.stage('geo', len(rows)):
+                rows = [row for row, us in zip(rows, self.geo_index.match_many([row[3] for row in rows])) if us]
+        if rows:
+            for row, pr in zip(rows, self.tweet_pr_batch([row[4] for row in rows])):
+                row.append(pr)
+            with profiler.stage('write', len(rows)):
+                csvout.writerows(rows)
+        return len(rows)
                         
     def split_tweets_tsv(self, tweet):
-        temp = []
-        ret = []
-        if  len(tweet) == 5:
-            geo_substrings = tweet[3].split(', ')
-            for g in geo_substrings:
-                if g in Geo:
-                    ret = tweet 
-                    break 
-                else:
-                    ret = ["null"]       
-        return ret
+        if len(tweet) != 5:
+            return []
+        if self.geo_index.match(tweet[3]):
+            return tweet
+        return ["null"]
         
     @classmethod    
     def tweet_pr(self, tweet):
         tweet = tweet.encode("utf-8") 
-        pr = 0
-        st_pr = 0
-        ngram_base = NGram_Helpers.build_tweet(tweet, 3, 1)
-        tri_gram = NGram_Helpers.build_ngrams(ngram_base, 3)
-        duo_gram = NGram_Helpers.build_ngrams(ngram_base, 2)
-        uno_gram = NGram_Helpers.build_ngrams(ngram_base, 1)
-        length = sum(lineOneGram.values())
-
-        count_3_list = NGram_Helpers.pr_gram(lineThreeGram, tri_gram)
-        count_2_list = NGram_Helpers.pr_gram(lineTwoGram, duo_gram[:len(tri_gram)])
-        count_1_list = NGram_Helpers.pr_gram(lineOneGram, uno_gram[:len(tri_gram)])
-        #if len(count_3_list[0]) > 0:
-        st_pr = NGram_Helpers.start_probability(count_3_list[0], count_2_list[0], L1, L4, length)
-        #if len(count_3_list[1]) > 0:
-        pr = NGram_Helpers.probability(count_3_list[1], count_2_list[1], count_1_list[1], L1, L2, L3, L4, length)
-        if st_pr != 0.0 and pr != 0.0:
-            pr = st_pr * pr
-        return pr
+        return self.tweet_pr_batch([tweet])[0]
+
+    @classmethod
+    def tweet_pr_batch(self, tweets, tokenizer=None):
+        """
+        Scores with File_Utils.scorer; log probabilities when log_prob is set.
+        """
+        with profiler.stage('score', len(tweets)):
+            if self.log_prob:
+                return self.scorer.log_scores(tweets, tokenizer=tokenizer)
+            return self.scorer.scores(tweets, tokenizer=tokenizer)
                  
     def remove_punct(self, samples):
         temp = []
         for s in samples:
-            if s != '\n':
-                if sentence_end_re.search(s):
-                    temp += re.split(sentence_end_re, s)
-                else:
-                    temp += [s]            
+            temp += Corpus.split_fragments(s)
         return temp
         
     def write_json(self, term_doc_matrix, file_name, root_dir='~/twitter/test_data/forumPost'):
         tweet_path = os.path.expanduser(root_dir)
-        with open(os.path.join(tweet_path, file_name), 'w') as outfile:
+        if isinstance(term_doc_matrix, NGram_Store):
+            term_doc_matrix = term_doc_matrix.to_dict()
+        with profiler.stage('write json', len(term_doc_matrix)), open(os.path.join(tweet_path, file_name), 'w') as outfile:
             h = json.JSONEncoder().encode(term_doc_matrix)
             json.dump(h, outfile, ensure_ascii=False)
         
+    def write_json_items(self, items, file_name, root_dir='~/twitter/test_data/forumPost'):
+        """
+        Writes ("a_b_c", count) pairs in the same double-encoded layout as
+        write_json(), one item at a time, so the model never has to be a dict.
+        """
+        tweet_path = os.path.expanduser(root_dir)
+        with profiler.stage('write json') as stage, open(os.path.join(tweet_path, file_name), 'w') as outfile:
+            outfile.write('"{')
+            sep = ''
+            for key, count in items:
+                item = '%s%s: %d' % (sep, json.dumps(key), count)
+                outfile.write(json.dumps(item, ensure_ascii=False)[1:-1])
+                sep = ', '
+                stage.add(1)
+            outfile.write('}"')
+
+    def iter_fragments(self, file_group, root_dir="~/Tweets"):
+        return Corpus(file_group, root_dir, self.use_mmap)
+
+    def read_model(self, file_name, n, vocab=None, root_dir="~/twitter/test_data/forumPost"):
+        """
+        A higher order read into a new vocabulary reads oneGram.json into it
+        first: keys of tokens with '_' in them are only cut right when every
+        token is known.
+        """
+        if vocab is None:
+            vocab = Vocabulary()
+        if n > 1 and len(vocab) == 0 and os.path.exists(os.path.join(os.path.expanduser(root_dir), "oneGram.json")):
+            self.read_model("oneGram.json", 1, vocab, root_dir)
+        return NGram_Store.from_dict(self.read_json(file_name, root_dir), n, vocab)
+
+    def read_models(self, root_dir="~/twitter/test_data/forumPost"):
+        """
+        Value: the trigram, bigram and unigram stores, mapped from nGram.bin
+        when it exists, otherwise read from the three JSON files. An
+        nGram.bin older than any of them is rebuilt from them first.
+        """
+        path = os.path.join(os.path.expanduser(root_dir), "nGram.bin")
+        with profiler.stage('load model'):
+            if os.path.exists(path):
+                json_paths = [os.path.join(os.path.expanduser(root_dir), name) for name in ("oneGram.json", "twoGram.json", "threeGram.json")]
+                if any(os.path.getmtime(json_path) > os.path.getmtime(path) for json_path in json_paths if os.path.exists(json_path)):
+                    print >> sys.stderr, "%s is older than the JSON models, rebuilding it" % path
+                    self.convert_json_model(root_dir)
+                model = Binary_Model(path)
+                return model.store(3), model.store(2), model.store(1)
+            vocab = Vocabulary()
+            # Unigrams first, so the vocabulary can settle keys of tokens with '_' in them:
+            one_gram = self.read_model("oneGram.json", 1, vocab, root_dir)
+            return self.read_model("threeGram.json", 3, vocab, root_dir), self.read_model("twoGram.json", 2, vocab, root_dir), one_gram
+
+    def write_binary_model(self, n, file_name="nGram.bin", root_dir='~/twitter/test_data/forumPost'):
+        """
+        Argument: n -- a trained NGram_Helpers
+        """
+        path = os.path.join(os.path.expanduser(root_dir), file_name)
+        with profiler.stage('write binary'):
+            Binary_Model.write(path, n.vocab.tokens, [n.unigrams.packed_items(), n.bigrams.packed_items(), n.trigrams.packed_items()])
+
+    def convert_json_model(self, root_dir='~/twitter/test_data/forumPost', file_name="nGram.bin"):
+        """
+        Converts threeGram.json, twoGram.json and oneGram.json into one binary model.
+        """
+        vocab = Vocabulary()
+        stores = [self.read_model(name, num, vocab, root_dir) for name, num in (("oneGram.json", 1), ("twoGram.json", 2), ("threeGram.json", 3))]
+        path = os.path.join(os.path.expanduser(root_dir), file_name)
+        Binary_Model.write(path, vocab.tokens, [n_store.packed_items() for n_store in stores])
+
     def read_json(self, file_name, root_dir="~/twitter/test_data/forumPost"):        
         tweet_path = os.path.expanduser(root_dir)
         with open(os.path.join(tweet_path, file_name)) as f:
@@ -527,14 +2328,289 @@ class File_Utils:
         return d
         
     def write_prob_csv(self, sentence, file_name, root_dir='~/twitter/test_data/forumPost'):
+        """
+        Argument: sentence -- an ordered dict or an iterable of (sentence, probability) pairs
+        """
         write_path = os.path.expanduser(root_dir)
-        writer = csv.writer(open(os.path.join(write_path, file_name), 'wb'))
-        #sort ordered dict highest to lowest probability
-        items = sentence.items()
-        items.reverse()
-        for key, value in sentence.items():
-            writer.writerow([key, value])
+        with open(os.path.join(write_path, file_name), 'wb') as f:
+            writer = csv.writer(f)
+            if hasattr(sentence, 'items'):
+                sentence = sentence.iteritems()
+            for key, value in sentence:
+                writer.writerow([key, value])
+
+    def score_corpus(self, corpus, batch_size=10000):
+        """
+        Value: (fragment, probability) for the first occurrence of every
+        fragment in corpus, scored batch_size fragments at a time. Besides
+        the batch, this keeps a 64 bit fingerprint of every distinct
+        fragment, so memory grows with the number of distinct fragments
+        (roughly 70 to 100 bytes each in the set), not just the longest line.
+        """
+        seen = Dup_Filter()
+        for batch in corpus.batches(batch_size):
+            batch = [f for f in batch if not seen.seen(f)]
+            for f, pr in zip(batch, self.tweet_pr_batch(batch)):
+                yield f, pr
             
+class Live_Metrics:
+    """
+    Counters and per-stage latencies of a Live_Pipeline. Latencies keep
+    the last window samples of each stage, in seconds.
+    """
+    # total runs from put() until the sink has the tweet:
+    STAGES = ('queue', 'parse', 'score', 'sink', 'total')
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.latency = dict((stage, collections.deque(maxlen=window)) for stage in self.STAGES)
+        self.queue_depth = lambda: 0
+        self.started = time.time()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def timing(self, stage, seconds):
+        with self.lock:
+            self.latency[stage].extend(seconds if isinstance(seconds, list) else [seconds])
+
+    def snapshot(self):
+        """
+        Value: a dict of the counters, the queue depth, the rate of scored
+        tweets and p50/p95/p99 milliseconds of every stage
+        """
+        with self.lock:
+            snap = dict(self.counts)
+            samples = dict((stage, list(values)) for stage, values in self.latency.items())
+        snap['queue_depth'] = self.queue_depth()
+        snap['scored_per_sec'] = snap.get('scored', 0) / max(time.time() - self.started, 1e-9)
+        for stage in self.STAGES:
+            if samples[stage]:
+                p50, p95, p99 = np.percentile(samples[stage], [50, 95, 99]) * 1000
+                snap[stage + '_ms'] = {'p50': p50, 'p95': p95, 'p99': p99}
+        return snap
+
+    def report(self):
+        snap = self.snapshot()
+        line = "received %d dropped %d scored %d skipped %d errors %d queue %d %.1f tweets/sec" % (
+            snap.get('received', 0), snap.get('dropped', 0), snap.get('scored', 0),
+            snap.get('skipped', 0), snap.get('errors', 0), snap['queue_depth'], snap['scored_per_sec'])
+        for stage in self.STAGES:
+            if stage + '_ms' in snap:
+                line += " | %s p50 %.1f p95 %.1f p99 %.1f ms" % ((stage,) + tuple(snap[stage + '_ms'][p] for p in ('p50', 'p95', 'p99')))
+        return line
+
+class Print_Sink:
+    """
+    Prints the fields on_data() always printed, then the probability.
+    """
+    def write(self, results):
+        for tweet, pr in results:
+            print tweet['id']
+            print tweet['created_at']
+            print tweet['text'].encode('utf-8')
+            print tweet['user']['name'].encode('utf-8')
+            print (tweet['user']['location'] or u'').encode('utf-8')
+            print pr
+
+    def close(self):
+        pass
+
+class CSV_Sink:
+    """
+    Appends id, created_at, user, location, text, probability rows to a CSV file.
+    """
+    def __init__(self, path):
+        self.f = open(os.path.expanduser(path), 'ab')
+        self.writer = csv.writer(self.f)
+
+    def write(self, results):
+        self.writer.writerows([[tweet['id'], tweet['created_at'], tweet['user']['name'].encode('utf-8'),
+                                (tweet['user']['location'] or u'').encode('utf-8'), tweet['text'].encode('utf-8'), pr]
+                               for tweet, pr in results])
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+class Live_Pipeline:
+    """
+    Takes raw stream payloads off the stream thread. put() only enqueues;
+    worker threads take micro-batches of up to batch_size payloads (or
+    whatever came within batch_wait seconds), parse them, score them in
+    one tweet_pr_batch() call and hand the results to sink.write().
+    Each worker scores with its own Tokenizer (and cache) against the
+    shared, read only scorer, so nothing but the sink is locked. The
+    tokenizing is pure Python and holds the GIL, though: workers overlap
+    the JSON parsing, numpy lookups and the sink, not the tokenizing.
+    A batch that raises is counted under errors and the worker goes on.
+    When the queue is full put() waits up to put_timeout for room and
+    then drops the payload, so a scoring spike slows the stream thread
+    down a little instead of stalling the connection.
+    """
+    def __init__(self, sink, workers=2, queue_size=10000, batch_size=100, batch_wait=0.2,
+                 put_timeout=0.05, report_every=0, metrics=None):
+        self.sink = sink
+        self.workers = workers
+        self.queue = Queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.put_timeout = put_timeout
+        self.report_every = report_every
+        self.metrics = metrics or Live_Metrics()
+        self.metrics.queue_depth = self.queue.qsize
+        # The sink is not thread safe:
+        self.sink_lock = threading.Lock()
+        self.threads = []
+        self.stopping = threading.Event()
+
+    def start(self):
+        for i in range(self.workers):
+            self.threads.append(threading.Thread(target=self.work, name="live-worker-%d" % i))
+        if self.report_every > 0:
+            self.threads.append(threading.Thread(target=self.report, name="live-metrics"))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def put(self, data):
+        """
+        Value: False when the payload was dropped
+        """
+        self.metrics.count('received')
+        try:
+            self.queue.put((time.time(), data), timeout=self.put_timeout)
+            return True
+        except Queue.Full:
+            self.metrics.count('dropped')
+            return False
+
+    def stop(self):
+        """
+        Scores what is still queued, then stops the workers.
+        """
+        for i in range(self.workers):
+            self.queue.put(None)
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.sink.close()
+
+    def next_batch(self):
+        """
+        Value: up to batch_size (enqueue time, payload) pairs, and whether
+        the stop marker was reached
+        """
+        item = self.queue.get()
+        if item is None:
+            return [], True
+        batch = [item]
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.time(), 0))
+            except Queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def work(self):
+        # The global tok's cache is not thread safe:
+        tokenizer = Tokenizer(preserve_case=tok.preserve_case, debug=tok.debug,
+                              cache_size=tok.cache.max_size if tok.cache is not None else 0)
+        stop = False
+        while not stop:
+            batch, stop = self.next_batch()
+            if not batch:
+                continue
+            try:
+                self.process(batch, tokenizer)
+            except Exception as e:
+                self.metrics.count('errors')
+                print >> sys.stderr, "%s: batch of %d failed: %s: %s" % (
+                    threading.current_thread().name, len(batch), type(e).__name__, e)
+
+    def process(self, batch, tokenizer=None):
+        now = time.time()
+        self.metrics.timing('queue', [now - queued for queued, data in batch])
+        tweets = []
+        for queued, data in batch:
+            try:
+                tweet = json.loads(data)
+            except ValueError:
+                tweet = None
+            # Deletes, limit notices and other non-tweet messages:
+            if not isinstance(tweet, dict) or 'text' not in tweet:
+                self.metrics.count('skipped')
+                continue
+            tweets.append(tweet)
+        parsed = time.time()
+        self.metrics.timing('parse', parsed - now)
+        if not tweets:
+            return
+        probabilities = File_Utils.tweet_pr_batch([t['text'].encode('utf-8') for t in tweets], tokenizer)
+        scored = time.time()
+        self.metrics.timing('score', scored - parsed)
+        with self.sink_lock:
+            self.sink.write(zip(tweets, probabilities))
+        done = time.time()
+        self.metrics.timing('sink', done - scored)
+        self.metrics.timing('total', [done - queued for queued, data in batch])
+        self.metrics.count('scored', len(tweets))
+        self.metrics.count('batches')
+
+    def report(self):
+        while not self.stopping.wait(self.report_every):
+            print >> sys.stderr, self.metrics.report()
+
+class Replay_Tweet:
+    """
+    Stands in for Live_Tweet without a connection: feeds recorded payloads
+    to the same StreamListener, at rate payloads per second or, with
+    rate 0, as fast as on_data() returns. A .jsonl source is replayed as
+    is; any other file is read as one tweet text per line and wrapped in
+    stream-shaped JSON.
+    """
+    def __init__(self, path, rate=0, repeat=1):
+        self.path = os.path.expanduser(path)
+        self.rate = rate
+        self.repeat = repeat
+        self.sent = 0
+        self.elapsed = 0.0
+
+    def payloads(self):
+        with open(self.path) as f:
+            if self.path.endswith('.jsonl'):
+                return [line for line in f if line.strip()]
+            return [self.tweet_json(i, line.rstrip('\r\n').decode('utf-8', 'replace'))
+                    for i, line in enumerate(f) if line.strip()]
+
+    @classmethod
+    def tweet_json(self, tweet_id, text):
+        return json.dumps({'id': tweet_id, 'created_at': time.strftime('%a %b %d %H:%M:%S +0000 %Y', time.gmtime()),
+                           'text': text, 'user': {'name': u'replay', 'location': None}})
+
+    def tokenize_live_tweet(self, client):
+        payloads = self.payloads()
+        start = time.time()
+        for i in range(self.repeat):
+            for data in payloads:
+                if self.rate > 0:
+                    delay = start + self.sent / self.rate - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.sent += 1
+                if client.on_data(data) is False:
+                    self.elapsed = time.time() - start
+                    return
+        self.elapsed = time.time() - start
+
 class Live_Tweet:
     def tokenize_live_tweet(self, client):
         consumer_key = ''
@@ -544,19 +2620,19 @@ class Live_Tweet:
         auth = OAuthHandler(consumer_key, consumer_secret)
         auth.set_access_token(access_token, access_secret)
         stream = Stream(auth, client)
-        stream.filter(locations=[-125.3,25.1,-66.9,48.6])
+        stream.filter(locations=list(Geo_Index.US_BBOX))
  
 class Live_Client(StreamListener):
+    """
+    Hands every payload to a Live_Pipeline and returns at once, so the
+    stream thread never waits on scoring.
+    """
+    def __init__(self, pipeline):
+        StreamListener.__init__(self)
+        self.pipeline = pipeline
+
     def on_data(self, data):
-        #print data
-        jsonized_tweet = json.loads(data)
-        decoded_tweet = json.JSONDecoder().decode(data)
-        print decoded_tweet['id']
-        print decoded_tweet['created_at']
-        print decoded_tweet['text']
-        print decoded_tweet['user']['name']
-        print decoded_tweet['user']['location']
-        print File_Utils.tweet_pr(decoded_tweet['text'])
+        self.pipeline.put(data)
         return True
 
     def on_error(self, status):
@@ -566,18 +2642,14 @@ class Live_Client(StreamListener):
 ###############################################################################
 
 if __name__ == '__main__':
-    tok = Tokenizer(preserve_case=False)
     fi = File_Utils()
 
-    posts = []
-    samples = []
-    temp = []
-    prob = collections.OrderedDict()
     L1 = 0.85
     L2 = 0.1
     L3 = 0.04
     L4 = 0.01
     st_pr = 0.0
+    batch_size = 10000
     
     geo_tweet_path = '~/twitter/test_data/GeoTweets'
     orig_tweet_path = '~/twitter/test_data/Tweets'
@@ -601,16 +2673,58 @@ if __name__ == '__main__':
     group.add_argument("-trc", "--tweet_recalculate", action="store_true")
     group.add_argument("-te", "--test", action="store_true")
     group.add_argument("-rt", "--run_test", action="store_true")   
+    group.add_argument("-cm", "--convert_model", action="store_true")
+    group.add_argument("-tw", "--tune_weights", action="store_true")
+    parser.add_argument("-d", "--debug", action="store_true", help="print the tokens of every document")
+    parser.add_argument("--cache_size", type=int, default=10000, help="texts kept in the tokenizer's LRU cache (0 disables)")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="worker processes for --clean, --train, --tweet_clean and --tweet_recalculate, scoring threads for --live_tweet")
+    parser.add_argument("-m", "--memory_budget", type=float, default=0, help="MB of counts to hold before --train spills sorted runs to disk (0 keeps everything in memory); counts in one process, so not with --workers. Either way the vocabulary holds at most 2**21 (2,097,152) distinct tokens; with a budget, a corpus over that fails while it is tokenized, before any counting")
+    parser.add_argument("--tmp_dir", help="directory for the --memory_budget spill runs (default: the system temp dir)")
+    parser.add_argument("--clean_rules", default=os.path.join(script_dir, 'clean_rules.txt'), help="rules file for --clean")
+    parser.add_argument("--log_prob", action="store_true", help="write natural log probabilities, which do not underflow on long posts")
+    parser.add_argument("--weights", type=float, nargs=4, metavar=("L1", "L2", "L3", "L4"), help="interpolation weights for trigram, bigram, unigram and uniform")
+    parser.add_argument("--dedup", choices=Dup_Filter.MODES, default='exact', help="duplicate line store for --clean")
+    parser.add_argument("--dedup_capacity", type=int, default=10000000, help="lines the bloom store is sized for")
+    parser.add_argument("--dedup_error", type=float, default=0.001, help="false positive rate of the bloom store at capacity")
+    parser.add_argument("--near_dup", type=float, default=0.8, help="shingle similarity the minhash store treats as a duplicate")
+    parser.add_argument("--mmap", action="store_true", help="read training and test files through mmap")
+    parser.add_argument("--queue_size", type=int, default=10000, help="--live_tweet payloads held for scoring before new ones are dropped")
+    parser.add_argument("--live_out", help="CSV file --live_tweet appends scored tweets to (default: print them)")
+    parser.add_argument("--metrics_every", type=float, default=60, help="seconds between --live_tweet metrics lines on stderr (0 for none)")
+    parser.add_argument("--replay", help="--live_tweet reads a .jsonl payload file or a text file of tweets instead of the stream")
+    parser.add_argument("--replay_rate", type=float, default=0, help="payloads per second for --replay (0 for as fast as possible)")
+    parser.add_argument("--replay_repeat", type=int, default=1, help="times --replay goes through the file")
+    parser.add_argument("--profile", metavar="REPORT.json", help="time every pipeline stage and write a JSON report at exit")
+    parser.add_argument("--profile_sample", type=int, default=0, metavar="N", help="with --profile, cProfile one in N calls of each stage, nested ones included, in the main thread (0 for none)")
+    parser.add_argument("--profile_memory", type=float, default=0, metavar="SECONDS", help="with --profile, take a memory snapshot at most this often (0 for none)")
+    parser.add_argument("--geo_bbox", action="store_true", help="--tweet_clean also keeps tweets whose location holds a lat,lon pair inside the US box")
     args = parser.parse_args()
+    if args.train and args.memory_budget > 0 and args.workers > 1:
+        parser.error("--memory_budget counts in one process; drop --workers or the budget")
+    if args.tmp_dir and args.memory_budget <= 0:
+        parser.error("--tmp_dir only holds --memory_budget spill runs")
+    if args.profile:
+        profiler.start(args.profile_sample, args.profile_memory)
+        atexit.register(profiler.write, args.profile)
+    File_Utils.log_prob = args.log_prob
+    File_Utils.use_mmap = args.mmap
+    if args.geo_bbox:
+        File_Utils.geo_index = Geo_Index(bbox=Geo_Index.US_BBOX)
+    if args.weights:
+        L1, L2, L3, L4 = args.weights
+    File_Utils.read_clean_rules(os.path.basename(args.clean_rules), os.path.dirname(args.clean_rules))
+    tok = Tokenizer(preserve_case=False, debug=args.debug, cache_size=args.cache_size)
     
     if args.clean: 
         #Section to clean data  
+        File_Utils.dup_filter = Dup_Filter(args.dedup, args.dedup_capacity, args.dedup_error, args.near_dup)
         file_group = fi.crawl_directory(training_dir1)
-        fi.gather(file_group,training_dir1)
+        fi.gather(file_group, training_dir1, workers=args.workers)
         file_group2 = fi.crawl_directory(training_dir2)
-        fi.gather(file_group2,training_dir2)
+        fi.gather(file_group2, training_dir2, workers=args.workers)
         forum_samples = fi.crawl_directory(test_path)
-        fi.gather(forum_samples, test_path)
+        fi.gather(forum_samples, test_path, workers=args.workers)
+        print File_Utils.dup_filter.report()
         #end section to clean data
         
     elif args.train:
@@ -618,66 +2732,53 @@ if __name__ == '__main__':
         file_group = fi.crawl_directory(training_dir1)
         file_group2 = fi.crawl_directory(training_dir2)
         Tokenizer.read_stopword_list()
-        samples += fi.create_samples(file_group,training_dir1)
-        samples += fi.create_samples(file_group2,training_dir2) 
-    
-        samples = fi.remove_punct(samples)
-        n = NGram_Helpers(samples)
-        fi.write_json(n.trigrams, "threeGram.json")
-        fi.write_json(n.bigrams, "twoGram.json")
-        fi.write_json(n.unigrams, "oneGram.json")
+        if args.memory_budget > 0:
+            counter = NGram_Spill_Counter(args.memory_budget, tmp_dir=args.tmp_dir)
+            try:
+                counter.count_samples(itertools.chain(fi.iter_fragments(file_group, training_dir1),
+                                                      fi.iter_fragments(file_group2, training_dir2)))
+                counter.write_json(fi, 3, "threeGram.json")
+                counter.write_json(fi, 2, "twoGram.json")
+                counter.write_json(fi, 1, "oneGram.json")
+                counter.write_binary()
+            finally:
+                counter.close()
+        else:
+            if args.workers > 1:
+                jobs = [(training_dir1, f) for f in file_group] + [(training_dir2, f) for f in file_group2]
+                n = NGram_Helpers.train_parallel(jobs, args.workers)
+            else:
+                n = NGram_Helpers(itertools.chain(fi.iter_fragments(file_group, training_dir1),
+                                                  fi.iter_fragments(file_group2, training_dir2)))
+            fi.write_json(n.trigrams, "threeGram.json")
+            fi.write_json(n.bigrams, "twoGram.json")
+            fi.write_json(n.unigrams, "oneGram.json")
+            fi.write_binary_model(n)
         #end section to create training data
         
     elif args.test:
         #Section to find prob of individual sentences from test data
-        lineThreeGram = fi.read_json("threeGram.json")
-        lineTwoGram = fi.read_json("twoGram.json")
-        lineOneGram = fi.read_json("oneGram.json") 
+        File_Utils.scorer = NGram_Scorer(*fi.read_models(), weights=(L1, L2, L3, L4)) 
 
         forum_samples = fi.crawl_directory(test_path)
         Tokenizer.read_stopword_list()
-        posts += fi.create_samples(forum_samples, test_path)
-        #print posts
-        forum_samples = fi.remove_punct(posts)
-        n = NGram_Helpers(forum_samples)
-        for f in forum_samples:
-            ngram_base = n.build_tweet(f, 3, 1)
-            tri_gram = n.build_ngrams(ngram_base, 3)
-            duo_gram = n.build_ngrams(ngram_base, 2)
-            uno_gram = n.build_ngrams(ngram_base, 1)
-            length = sum(lineOneGram.values())
-
-            count_3_list = n.pr_gram(lineThreeGram, tri_gram)
-            count_2_list = n.pr_gram(lineTwoGram, duo_gram[:len(tri_gram)])
-            count_1_list = n.pr_gram(lineOneGram, uno_gram[:len(tri_gram)])
-            #if len(count_3_list[0]) > 0:
-            st_pr = n.start_probability(count_3_list[0], count_2_list[0], L1, L4, length)
-            #if len(count_3_list[1]) > 0:
-            pr = n.probability(count_3_list[1], count_2_list[1], count_1_list[1], L1, L2, L3, L4, length)
-            if st_pr != 0.0 and pr != 0.0:
-                pr = st_pr * pr
-            prob[f] = pr
-        fi.write_prob_csv(prob,"probability.csv")
+        fi.write_prob_csv(fi.score_corpus(fi.iter_fragments(forum_samples, test_path), batch_size), "probability.csv")
         #end test data section
         
     elif args.tweet_clean:
         #Section to separate tweets by Geolocation and return only US tweets and their probabilities
-        lineThreeGram = fi.read_json("threeGram.json")
-        lineTwoGram = fi.read_json("twoGram.json")
-        lineOneGram = fi.read_json("oneGram.json") 
+        File_Utils.scorer = NGram_Scorer(*fi.read_models(), weights=(L1, L2, L3, L4)) 
         Tokenizer.read_stopword_list()
         file_group = fi.crawl_directory(orig_tweet_path)
-        fi.parse_tsv_tweets(file_group, out_path=geo_tweet_path,method_name=2)
+        fi.parse_tsv_tweets(file_group, root_dir=orig_tweet_path, out_path=geo_tweet_path, method_name=2, workers=args.workers)
         #end section to return US tweets
         
     elif args.tweet_recalculate:
         #Section to recalculate probabilities for tweets based on new training data
-        lineThreeGram = fi.read_json("threeGram.json")
-        lineTwoGram = fi.read_json("twoGram.json")
-        lineOneGram = fi.read_json("oneGram.json") 
+        File_Utils.scorer = NGram_Scorer(*fi.read_models(), weights=(L1, L2, L3, L4)) 
         Tokenizer.read_stopword_list()
         file_group = fi.crawl_directory(geo_tweet_path)
-        fi.parse_tsv_tweets(file_group, root_dir=geo_tweet_path, out_path=geo_tweet_path,method_name=5)
+        fi.parse_tsv_tweets(file_group, root_dir=geo_tweet_path, out_path=geo_tweet_path, method_name=5, workers=args.workers)
         #end section to recalculate probabilities for tweets based on new training data
         
     elif args.run_test:
@@ -685,25 +2786,51 @@ if __name__ == '__main__':
         file_group = fi.crawl_directory(run_test_path)
         Tokenizer.read_stopword_list()
         fi.gather(file_group,run_test_path)
-        samples += fi.create_samples(file_group,run_test_path)    
-        samples = fi.remove_punct(samples)
-        n = NGram_Helpers(samples)
+        n = NGram_Helpers(fi.iter_fragments(file_group, run_test_path))
         fi.write_json(n.trigrams, "threeGram.json", run_test_out_path)
         fi.write_json(n.bigrams, "twoGram.json", run_test_out_path)
         fi.write_json(n.unigrams, "oneGram.json", run_test_out_path)
         fi.parse_tsv_tweets(file_group, out_path=run_test_tweet_path)
         #end section to test functionality with toy data set
+
+    elif args.tune_weights:
+        #Section to fit L1..L4 on the test data
+        scorer = NGram_Scorer(*fi.read_models(), weights=(L1, L2, L3, L4))
+        Tokenizer.read_stopword_list()
+        held_out = fi.iter_fragments(fi.crawl_directory(test_path), test_path)
+        vectors = scorer.count_vectors(list(tok.tokenize_many(held_out)))
+        print "current weights %s log likelihood %f" % ((L1, L2, L3, L4), scorer.log_scores_from_counts(vectors).sum())
+        for method in ('grid', 'em'):
+            weights, likelihood = scorer.tune_weights(vectors, method)
+            print "%-4s log likelihood %f --weights %s" % (method, likelihood, " ".join("%.4f" % w for w in weights))
+        #end section to fit L1..L4
+
+    elif args.convert_model:
+        #Section to convert the JSON model files into nGram.bin
+        fi.convert_json_model()
+        #end section to convert the JSON model files
    
     elif args.live_tweet:
         #Section to return probabilities of US tweets from live stream
-        lineThreeGram = fi.read_json("threeGram.json")
-        lineTwoGram = fi.read_json("twoGram.json")
-        lineOneGram = fi.read_json("oneGram.json") 
+        File_Utils.scorer = NGram_Scorer(*fi.read_models(), weights=(L1, L2, L3, L4)) 
         Tokenizer.read_stopword_list()
-        l = Live_Client()
-        k = Live_Tweet()
-        k.tokenize_live_tweet(l)
+        sink = CSV_Sink(args.live_out) if args.live_out else Print_Sink()
+        pipeline = Live_Pipeline(sink, workers=args.workers, queue_size=args.queue_size, report_every=args.metrics_every).start()
+        l = Live_Client(pipeline)
+        k = Replay_Tweet(args.replay, args.replay_rate, args.replay_repeat) if args.replay else Live_Tweet()
+        start = time.time()
+        try:
+            k.tokenize_live_tweet(l)
+        finally:
+            pipeline.stop()
+            print >> sys.stderr, pipeline.metrics.report()
+            if args.replay:
+                print >> sys.stderr, "replayed %d payloads, sustained %.1f tweets/sec" % (
+                    k.sent, pipeline.metrics.snapshot().get('scored', 0) / (time.time() - start))
         #end section to return probabilities of US tweets from live stream
+
+    if args.debug and tok.cache is not None:
+        print "tokenizer cache:", tok.cache.stats()
     """
     #ask for user input
 
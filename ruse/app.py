@@ -31,13 +31,26 @@ import struct
 import Image
 import scipy
 import scipy.misc
-import scipy.cluster
-import urllib, cStringIO
+import urllib2, cStringIO
+import Queue
+import threading
+import time
 from random import randint, randrange
 from werkzeug import secure_filename
+from dominant import Dominant_Color
  
 app = flask.Flask(__name__)
 col =''
+# Photos searched per request, fetched PHOTO_WORKERS at a time; each
+# fetch gives up after PHOTO_TIMEOUT seconds without data and the whole
+# search after PICTURES_DEADLINE seconds.
+PHOTO_LIMIT = 50
+PHOTO_WORKERS = 8
+PHOTO_TIMEOUT = 5
+PICTURES_DEADLINE = 20
+MATCHES = 3
+# Shared by the photo workers; it keeps no state between images:
+dominant = Dominant_Color('minibatch')
 @app.route('/')
 def colorRand(): 
     color = genRandomColor()
@@ -90,58 +103,90 @@ def genRandomColor():
      print thestr
      return thestr 
 
-def get_pictures(required):
+def get_pictures(required, target=None):
+    """
+    Value: the first three photos from the search for required whose
+    dominant color has the name of target (default the page's color),
+    in the order they finish, with 'none' for any not found
+    """
+    cat = (target or col).lower()
+    req = webcolors.hex_to_rgb(cat)
+    new_cat = get_color_name(cat, req)
+    print cat
     gd_client = gdata.photos.service.PhotosService()
-    photos = gd_client.SearchCommunityPhotos(required, limit='50')
-    no_error = False
-    j = 0
-    count = 0
-    purl1 = 'none'
-    purl2 = 'none'
-    purl3 = 'none'
-    for photo in photos.entry:
-        if j < 50:
-            purl=photo.content.src
-            NUM_CLUSTERS = 5
-            print 'reading image'
-            URL = purl
-            file = cStringIO.StringIO(urllib.urlopen(URL).read())
-            im = Image.open(file)
-            im = im.resize((150, 150))      # optional, to reduce time
-            ar = scipy.misc.fromimage(im)
-            shape = ar.shape
-            ar = ar.reshape(scipy.product(shape[:2]), shape[2])
-            print 'finding clusters'
-            codes, dist = scipy.cluster.vq.kmeans(ar, NUM_CLUSTERS)
-            print 'cluster centres:\n', codes
-            vecs, dist = scipy.cluster.vq.vq(ar, codes)         # assign codes
-            counts, bins = scipy.histogram(vecs, len(codes))    # count occurrences
-            index_max = scipy.argmax(counts)                    # find most frequent
-            peak = codes[index_max]
-            color = ''.join(chr(c) for c in peak).encode('hex')
-            various=''.join(['#', color])
-            new_color=get_color_name(various, peak)
-            new_name=webcolors.name_to_hex(new_color, spec='css3')
-            print new_name
-            print 'most frequent is %s (#%s)' % (peak, color)
-            cat = col.lower()
-            req = webcolors.hex_to_rgb(cat)
-            new_cat=get_color_name(cat, req)
-            print cat
-            j += 1
-            print j
+    photos = gd_client.SearchCommunityPhotos(required, limit=str(PHOTO_LIMIT))
+    urls = Queue.Queue()
+    for photo in photos.entry[:PHOTO_LIMIT]:
+        urls.put(photo.content.src)
+    pending = urls.qsize()
+    results = Queue.Queue()
+    stopping = threading.Event()
+    for i in range(min(PHOTO_WORKERS, pending)):
+        # Daemons, so a fetch still running when the page is sent is dropped:
+        worker = threading.Thread(target=photo_worker, args=(urls, results, stopping))
+        worker.daemon = True
+        worker.start()
+    matches = []
+    deadline = time.time() + PICTURES_DEADLINE
+    try:
+        while pending and len(matches) < MATCHES:
+            try:
+                purl, new_color = results.get(timeout=max(deadline - time.time(), 0))
+            except Queue.Empty:
+                print 'gave up on %d photos' % pending
+                break
+            pending -= 1
             if new_color == new_cat:
-                no_error = True
-                count += 1
-                print count
-                if count == 1:
-                    purl1 = purl
-                if count == 2:
-                    purl2 = purl
-                if count == 3:
-                    purl3 = purl
-            if j == 50 or count == 3: 
-                return purl1, purl2, purl3            
+                matches.append(purl)
+                print len(matches)
+    finally:
+        # Workers finish the photo in hand and take no more:
+        stopping.set()
+    matches += ['none'] * (MATCHES - len(matches))
+    return tuple(matches)
+
+def photo_worker(urls, results, stopping):
+    """
+    Puts (url, color name) on results for urls until it is empty or
+    stopping is set; the name is None if the photo could not be read.
+    """
+    while not stopping.is_set():
+        try:
+            purl = urls.get_nowait()
+        except Queue.Empty:
+            return
+        new_color = None
+        try:
+            new_color = photo_color(purl)
+        except Exception as e:
+            # Bad downloads (IncompleteRead), truncated or huge images:
+            # one photo must not take its worker down and stall get_pictures.
+            print '%s: %s: %s' % (purl, type(e).__name__, e)
+        finally:
+            results.put((purl, new_color))
+
+def photo_color(purl):
+    """
+    Value: the css3 name closest to the dominant color of the photo at purl
+    """
+    print 'reading image'
+    file = cStringIO.StringIO(urllib2.urlopen(purl, timeout=PHOTO_TIMEOUT).read())
+    im = Image.open(file)
+    peak = dominant_color(im)
+    color = ''.join(chr(c) for c in peak).encode('hex')
+    various=''.join(['#', color])
+    new_color=get_color_name(various, peak)
+    print 'most frequent is %s (#%s)' % (peak, color)
+    return new_color
+
+def dominant_color(im):
+    """
+    Value: the centre of the largest of 5 k-means clusters of im's
+    pixels, as (r, g, b) ints
+    """
+    im = im.convert('RGB')          # grayscale and palette images have no color channels
+    im = im.resize((150, 150))      # optional, to reduce time
+    return dominant.color(scipy.misc.fromimage(im))
 
 def get_color_name(various, peak):
         try:
@@ -0,0 +1,289 @@
+#
+# Copyright (c) 2012 Meg Ford
+#
+# Ruse is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Ruse is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with Ruse; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""
+The dominant color of photos, for get_pictures.
+
+    python dominant.py [--images 200] [--size 150] [--batch 16] [--seed 0] [--tolerance 24] [--margin 1.2]
+
+benchmarks every mode on seeded synthetic photos against scipy's k-means,
+which get_pictures used to run on each photo, printing images/sec and how
+often each mode finds the same color.
+"""
+
+from __future__ import division
+
+import argparse
+import time
+
+import numpy as np
+try:
+    import scipy.cluster.vq
+except ImportError:
+    scipy = None
+try:
+    import webcolors
+except ImportError:
+    webcolors = None
+
+class Dominant_Color:
+    """
+    mode:
+    minibatch -- k-means as get_pictures ran it, but seeded with
+                 k-means++ on a sample of each image, moved by mini-batches
+                 of pixels, refined on the sample, and the best of restarts
+                 over all pixels kept; every image of a batch is clustered
+                 at once
+    histogram -- pixels counted in 2**bits levels per channel; the mean
+                 color around the fullest bin. Fastest, but the most common
+                 color rather than the largest cluster
+    kmeans    -- scipy.cluster.vq.kmeans on every pixel, an image at a time
+    Colors are (r, g, b) ints. Randomness comes from seed alone, drawn
+    afresh for every image, so an image gets the same color whatever
+    batch it is in.
+    """
+    MODES = ('minibatch', 'histogram', 'kmeans')
+
+    def __init__(self, mode='minibatch', clusters=5, bits=3, sample=2048, batch_size=256, iterations=20, refine=5,
+                 restarts=8, seed=0):
+        if mode not in self.MODES:
+            raise ValueError("unknown mode %r" % mode)
+        if mode == 'kmeans' and scipy is None:
+            raise ValueError("the kmeans mode needs scipy installed")
+        self.mode = mode
+        self.clusters = clusters
+        self.bits = bits
+        self.sample = sample
+        self.batch_size = batch_size
+        self.iterations = iterations
+        self.refine = refine
+        self.restarts = restarts
+        self.seed = seed
+
+    def color(self, image):
+        """
+        image: (height, width, 3) array, e.g. scipy.misc.fromimage(im)
+        """
+        return self.colors([image])[0]
+
+    def colors(self, images):
+        """
+        images: equal sized (height, width, 3) arrays, or one
+        (n, height, width, 3) or (n, pixels, 3) array; a fourth alpha
+        channel is ignored
+        Value: list of (r, g, b)
+        """
+        pixels = np.asarray(images)
+        if pixels.ndim not in (3, 4) or pixels.shape[-1] not in (3, 4):
+            raise ValueError("expected RGB images, got an array of shape %s; "
+                             "convert('RGB') grayscale and palette images first" % (pixels.shape,))
+        pixels = pixels.reshape(pixels.shape[0], -1, pixels.shape[-1])[:, :, :3]
+        if self.mode == 'histogram':
+            peaks = self.histogram(pixels)
+        elif self.mode == 'minibatch':
+            peaks = self.minibatch(pixels)
+        else:
+            peaks = np.array([kmeans_clusters(p, self.clusters, self.seed)[0] for p in pixels])
+        return [tuple(int(c) for c in peak) for peak in np.clip(np.round(peaks), 0, 255)]
+
+    def histogram(self, pixels):
+        n, size = pixels.shape[:2]
+        levels = 2 ** self.bits
+        q = (pixels >> (8 - self.bits)).astype(np.int64)
+        bins = (q[:, :, 0] * levels + q[:, :, 1]) * levels + q[:, :, 2]
+        # One bincount for the whole batch, each image in its own range:
+        counts = np.bincount((bins + np.arange(n)[:, None] * levels ** 3).ravel(),
+                             minlength=n * levels ** 3).reshape(n, levels, levels, levels)
+        # A color on a bin edge is split over two bins; sum each bin with
+        # its neighbours before picking the fullest:
+        for axis in (1, 2, 3):
+            padded = np.pad(counts, [(1, 1) if a == axis else (0, 0) for a in range(4)], 'constant')
+            shifted = lambda s: padded[tuple(s if a == axis else slice(None) for a in range(4))]
+            counts = shifted(slice(0, -2)) + shifted(slice(1, -1)) + shifted(slice(2, None))
+        peak = np.array(np.unravel_index(counts.reshape(n, -1).argmax(1), (levels, levels, levels))).T
+        near = (np.abs(q - peak[:, None, :]) <= 1).all(2)
+        return (pixels * near[:, :, None]).sum(1) / near.sum(1)[:, None]
+
+    def minibatch(self, pixels):
+        """
+        Every image gets restarts runs, as scipy's kmeans does, all
+        clustered together; mini-batch steps are Sculley's, each centre
+        moving 1/(pixels it has seen) of the way to its new pixels.
+        """
+        n, size = pixels.shape[:2]
+        # A generator per image, so its color does not depend on the batch:
+        rngs = [np.random.RandomState(self.seed) for i in range(n)]
+        k = min(self.clusters, size)
+        runs = n * self.restarts
+        image = np.repeat(np.arange(n), self.restarts)[:, None]
+        sample = pixels[image, self.draw(rngs, 'randint', 0, size, (self.restarts, self.sample))].astype(np.float64)
+        centres = self.seed_centres(sample, k, rngs)
+        seen = np.zeros((runs, k))
+        for i in range(self.iterations):
+            batch = pixels[image, self.draw(rngs, 'randint', 0, size, (self.restarts, self.batch_size))].astype(np.float64)
+            counts, sums = self.cluster_sums(batch, centres)
+            seen += counts
+            centres += (sums - centres * counts[:, :, None]) / np.maximum(seen, 1)[:, :, None]
+        for i in range(self.refine):
+            counts, sums = self.cluster_sums(sample, centres)
+            # An empty cluster keeps its centre:
+            centres = np.where(counts[:, :, None] > 0, sums / np.maximum(counts, 1)[:, :, None], centres)
+        # scipy's choice between restarts: least mean distance, measured on
+        # every pixel (on the sample alone it often keeps a worse run), an
+        # image at a time so the distances stay restarts * pixels * k
+        peaks = []
+        for i in range(n):
+            runs_i = centres[i * self.restarts:(i + 1) * self.restarts]
+            d = self.distances(np.repeat(pixels[i:i + 1].astype(np.float64), self.restarts, 0), runs_i)
+            best = np.sqrt(d.min(2)).mean(1).argmin()
+            peaks.append(runs_i[best, np.bincount(d[best].argmin(1), minlength=k).argmax()])
+        return np.array(peaks)
+
+    def draw(self, rngs, method, *args):
+        """
+        Value: every image's draw of rngs[i].method(*args), stacked along
+        the first axis, as the runs of the images are
+        """
+        return np.concatenate([getattr(rng, method)(*args) for rng in rngs])
+
+    def seed_centres(self, sample, k, rngs):
+        """
+        k-means++: each centre drawn with odds the squared distance to
+        the nearest one so far.
+        """
+        runs, size = sample.shape[:2]
+        rows = np.arange(runs)
+        centres = sample[rows, self.draw(rngs, 'randint', 0, size, self.restarts)][:, None, :]
+        for i in range(1, k):
+            odds = self.distances(sample, centres).min(2).cumsum(1)
+            pick = (odds < self.draw(rngs, 'uniform', 0, 1, (self.restarts, 1)) * odds[:, -1:]).sum(1)
+            centres = np.concatenate([centres, sample[rows, np.minimum(pick, size - 1)][:, None, :]], 1)
+        return centres
+
+    def distances(self, pixels, centres):
+        """
+        Value: (runs, pixels, centres) squared distances
+        """
+        # As |p|^2 - 2p.c + |c|^2, one matmul for every run:
+        d = (pixels ** 2).sum(2)[:, :, None] - 2 * np.matmul(pixels, centres.transpose(0, 2, 1)) + \
+            (centres ** 2).sum(2)[:, None, :]
+        return np.maximum(d, 0)
+
+    def cluster_sums(self, pixels, centres):
+        """
+        Value: (runs, centres) pixel counts and (runs, centres, 3) sums of
+        the pixels nearest each centre
+        """
+        nearest = self.distances(pixels, centres).argmin(2)
+        members = (nearest[:, :, None] == np.arange(centres.shape[1])).astype(np.float64)
+        return members.sum(1), np.matmul(members.transpose(0, 2, 1), pixels)
+
+def kmeans_clusters(pixels, clusters=5, seed=0):
+    """
+    What get_pictures did: scipy's kmeans, then every pixel counted with vq.
+    Value: the largest cluster's centre, the clusters' shares of pixels
+    """
+    np.random.seed(seed)
+    obs = pixels.astype(np.float64)
+    codes, dist = scipy.cluster.vq.kmeans(obs, clusters)
+    vecs, dist = scipy.cluster.vq.vq(obs, codes)
+    counts = np.bincount(vecs, minlength=len(codes))
+    return codes[counts.argmax()], counts / counts.sum()
+
+def synthetic_photos(n, size=150, seed=0):
+    """
+    Value: (n, size, size, 3) uint8 -- 2 to 6 colored regions of random
+    area each, shaded and noisy like a photo
+    """
+    rng = np.random.RandomState(seed)
+    yx = np.indices((size, size)).reshape(2, -1).T
+    photos = np.empty((n, size * size, 3))
+    for i in range(n):
+        regions = rng.randint(2, 7)
+        palette = rng.randint(0, 256, (regions, 3))
+        centres = rng.randint(0, size, (regions, 2))
+        # Weighted Voronoi cells, so some regions dominate:
+        reach = rng.uniform(0.5, 2.0, regions)
+        label = (((yx[:, None, :] - centres[None]) ** 2).sum(2) / reach ** 2).argmin(1)
+        shade = 1 + rng.uniform(-0.15, 0.15) * (yx[:, 0] / size - 0.5)
+        photos[i] = palette[label] * shade[:, None] + rng.normal(0, 8, (size * size, 3))
+    return np.clip(photos, 0, 255).astype(np.uint8).reshape(n, size, size, 3)
+
+def closest_name(rgb):
+    """
+    The css3 name get_pictures compares photos by.
+    """
+    best = None
+    for key, name in webcolors.css3_hex_to_names.items():
+        d = sum((a - b) ** 2 for a, b in zip(webcolors.hex_to_rgb(key), rgb))
+        if best is None or d < best[0]:
+            best = (d, name)
+    return best[1]
+
+def bench(images=200, size=150, batch=16, seed=0, tolerance=24, margin=1.2):
+    """
+    Agreement is with kmeans: close is within tolerance in RGB distance,
+    names compares the css3 names get_pictures matches on, when webcolors
+    is installed. clear counts only the photos whose largest kmeans
+    cluster is margin times the next; on the rest which of two near
+    equal clusters wins is luck, as kmeans at another seed shows.
+    """
+    photos = synthetic_photos(images, size, seed).reshape(images, size * size, 3)
+    print "%d synthetic %dx%d photos, seed %d" % (images, size, size, seed)
+    start = time.time()
+    reference, clear = [], []
+    for pixels in photos:
+        peak, shares = kmeans_clusters(pixels, seed=seed)
+        reference.append(peak)
+        shares = np.sort(shares)
+        clear.append(shares[-1] >= margin * shares[-2])
+    reference = np.clip(np.round(reference), 0, 255)
+    clear = np.array(clear)
+    results = {'kmeans': images / (time.time() - start)}
+    print "%-18s %8.1f images/sec %6.1fx  %d of %d clear" % ('kmeans', results['kmeans'], 1, clear.sum(), images)
+    runs = [('kmeans, seed+1', Dominant_Color('kmeans', seed=seed + 1), 1)]
+    for mode in ('minibatch', 'histogram'):
+        runs.append((mode, Dominant_Color(mode, seed=seed), batch))
+        runs.append((mode + ', 1/call', Dominant_Color(mode, seed=seed), 1))
+    for name, dominant, per_call in runs:
+        start = time.time()
+        found = []
+        for i in range(0, images, per_call):
+            found.extend(dominant.colors(photos[i:i + per_call]))
+        elapsed = time.time() - start
+        found = np.array(found)
+        close = np.sqrt(((found - reference) ** 2).sum(1)) <= tolerance
+        agreement = "close %5.1f%%, clear %5.1f%%" % (100 * close.mean(), 100 * close[clear].mean())
+        if webcolors is not None:
+            same = np.array([closest_name(a) == closest_name(b) for a, b in zip(found, reference)])
+            agreement += ", names %5.1f%%" % (100 * same.mean())
+        results[name] = images / elapsed
+        print "%-18s %8.1f images/sec %6.1fx  %s" % (name, results[name], results[name] / results['kmeans'], agreement)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--size", type=int, default=150, help="get_pictures resizes photos to 150x150")
+    parser.add_argument("--batch", type=int, default=16, help="images per call in the batched modes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tolerance", type=float, default=24, help="RGB distance counted as the same color")
+    parser.add_argument("--margin", type=float, default=1.2, help="how much larger the largest kmeans cluster of a clear photo is")
+    args = parser.parse_args()
+    if scipy is None:
+        parser.error("the benchmark compares with scipy's kmeans; install scipy")
+    bench(args.images, args.size, args.batch, args.seed, args.tolerance, args.margin)